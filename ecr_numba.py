@@ -0,0 +1,404 @@
+"""
+Optional Numba JIT backend for the Edge Change Ratio.
+
+The greyscale, gaussian, canny, dilation and composite stages of
+scene_cut_detect.edge_change_ratio are fused into a few nogil loops over
+preallocated per thread buffers, so frames can be scored in parallel threads.
+Contours are still counted with skimage.measure.find_contours.
+
+Without Numba installed edge_change_ratio is the NumPy/skimage reference.
+"""
+from threading import local
+from multiprocessing.pool import ThreadPool
+from skimage import measure
+from skimage.morphology import dilation, square
+from scene_cut_detect import edge_change_ratio as reference_edge_change_ratio
+import numpy as np
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+    jit = njit(nogil=True, cache=True)
+else:
+    def jit(function):
+        return function  # Never called, edge_change_ratio falls back
+
+_buffers = local()  # Per thread work buffers keyed by frame shape
+_dilation_probe = dict()
+
+
+def gaussian_kernel(sigma, truncate=4.0):
+    """1D gaussian weights as scipy.ndimage.gaussian_filter builds them"""
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    weights = np.exp(-0.5 * x ** 2 / float(sigma) ** 2)
+    return weights / weights.sum()
+
+
+def dilation_geometry(distance):
+    """
+    Probe skimage's dilation once per distance, its window offsets and the
+    value of a dilated edge pixel differ between versions and the composite
+    adds that value to a uint8 image, so the reference must be matched
+    :return: tuple (offset before, offset after, edge value)
+    """
+    if distance not in _dilation_probe:
+        size = distance * 3
+        probe = np.zeros((size, size), bool)
+        probe[distance + distance // 2, distance + distance // 2] = True
+        dilated = np.asarray(dilation(probe, square(distance)))
+        rows = np.nonzero(dilated.any(1))[0]
+        centre = distance + distance // 2
+        # A pixel spreads down as far as the window looks back, and up
+        _dilation_probe[distance] = (int(rows[-1] - centre),
+                                     int(centre - rows[0]),
+                                     int(dilated.max()))
+    return _dilation_probe[distance]
+
+
+@jit
+def _reflect(i, n):
+    if i < 0:
+        return -i - 1
+    if i >= n:
+        return 2 * n - i - 1
+    return i
+
+
+@jit
+def _edge_map(frame, weights, low_threshold, high_threshold, grey, blur,
+              smooth, isobel, jsobel, magnitude, state, stack, edge):
+    """canny(desaturate(frame)) into edge"""
+    h, w = grey.shape
+    radius = weights.shape[0] // 2
+    taps = weights.shape[0]
+
+    # Desaturated HSV value is the brightest channel
+    for r in range(h):
+        for c in range(w):
+            v = frame[r, c, 0]
+            if frame[r, c, 1] > v:
+                v = frame[r, c, 1]
+            if frame[r, c, 2] > v:
+                v = frame[r, c, 2]
+            grey[r, c] = v
+
+    # Gaussian along axis 0 then axis 1, zero padded and normalised by the
+    # blurred all ones mask like skimage's smooth_with_function_and_mask
+    for r in range(h):
+        for c in range(w):
+            blur[r, c] = 0.0
+        for k in range(max(0, radius - r), min(taps, h - r + radius)):
+            wk = weights[k]
+            rr = r + k - radius
+            for c in range(w):
+                blur[r, c] += wk * grey[rr, c]
+    for r in range(h):
+        row_norm = 0.0
+        for k in range(max(0, radius - r), min(taps, h - r + radius)):
+            row_norm += weights[k]
+        for c in range(w):
+            acc = 0.0
+            col_norm = 0.0
+            for k in range(max(0, radius - c), min(taps, w - c + radius)):
+                acc += weights[k] * blur[r, c + k - radius]
+                col_norm += weights[k]
+            smooth[r, c] = acc / (row_norm * col_norm + 2.220446049250313e-16)
+
+    # Sobel, reflect mode
+    for r in range(h):
+        r0 = _reflect(r - 1, h)
+        r2 = _reflect(r + 1, h)
+        for c in range(w):
+            c0 = _reflect(c - 1, w)
+            c2 = _reflect(c + 1, w)
+            i = (smooth[r2, c0] - smooth[r0, c0]) + \
+                2.0 * (smooth[r2, c] - smooth[r0, c]) + \
+                (smooth[r2, c2] - smooth[r0, c2])
+            j = (smooth[r0, c2] - smooth[r0, c0]) + \
+                2.0 * (smooth[r, c2] - smooth[r, c0]) + \
+                (smooth[r2, c2] - smooth[r2, c0])
+            isobel[r, c] = i
+            jsobel[r, c] = j
+            magnitude[r, c] = np.sqrt(i * i + j * j)
+
+    # Non maximum suppression and double threshold, later sectors win
+    # where they overlap just like the masked assignments in skimage
+    for r in range(h):
+        for c in range(w):
+            state[r, c] = 0
+    for r in range(1, h - 1):
+        for c in range(1, w - 1):
+            m = magnitude[r, c]
+            if m <= 0:
+                continue
+            i = isobel[r, c]
+            j = jsobel[r, c]
+            ai = abs(i)
+            aj = abs(j)
+            maximum = False
+            if ((i >= 0 and j >= 0) or (i <= 0 and j <= 0)) and ai >= aj:
+                wt = aj / ai
+                maximum = (
+                    magnitude[r + 1, c + 1] * wt +
+                    magnitude[r + 1, c] * (1 - wt) <= m and
+                    magnitude[r - 1, c - 1] * wt +
+                    magnitude[r - 1, c] * (1 - wt) <= m)
+            if ((i >= 0 and j >= 0) or (i <= 0 and j <= 0)) and ai <= aj:
+                wt = ai / aj
+                maximum = (
+                    magnitude[r + 1, c + 1] * wt +
+                    magnitude[r, c + 1] * (1 - wt) <= m and
+                    magnitude[r - 1, c - 1] * wt +
+                    magnitude[r, c - 1] * (1 - wt) <= m)
+            if ((i <= 0 and j >= 0) or (i >= 0 and j <= 0)) and ai <= aj:
+                wt = ai / aj
+                maximum = (
+                    magnitude[r - 1, c + 1] * wt +
+                    magnitude[r, c + 1] * (1 - wt) <= m and
+                    magnitude[r + 1, c - 1] * wt +
+                    magnitude[r, c - 1] * (1 - wt) <= m)
+            if ((i <= 0 and j >= 0) or (i >= 0 and j <= 0)) and ai >= aj:
+                wt = aj / ai
+                maximum = (
+                    magnitude[r - 1, c + 1] * wt +
+                    magnitude[r - 1, c] * (1 - wt) <= m and
+                    magnitude[r + 1, c - 1] * wt +
+                    magnitude[r + 1, c] * (1 - wt) <= m)
+            if maximum:
+                if m >= high_threshold:
+                    state[r, c] = 2
+                elif m >= low_threshold:
+                    state[r, c] = 1
+
+    # Hysteresis, keep 8-connected low components touching a high pixel
+    for r in range(h):
+        for c in range(w):
+            edge[r, c] = False
+    for r in range(h):
+        for c in range(w):
+            if state[r, c] != 2 or edge[r, c]:
+                continue
+            edge[r, c] = True
+            top = 0
+            stack[top] = r * w + c
+            top += 1
+            while top > 0:
+                top -= 1
+                pr = stack[top] // w
+                pc = stack[top] % w
+                for dr in range(-1, 2):
+                    for dc in range(-1, 2):
+                        nr = pr + dr
+                        nc = pc + dc
+                        if 0 <= nr < h and 0 <= nc < w and \
+                                state[nr, nc] != 0 and not edge[nr, nc]:
+                            edge[nr, nc] = True
+                            stack[top] = nr * w + nc
+                            top += 1
+
+
+@jit
+def _dilate(edge, before, after, counts, rows, out):
+    """Square dilation of edge as two running window passes into out"""
+    h, w = edge.shape
+    for c in range(w):
+        counts[0] = 0
+        for r in range(h):
+            counts[r + 1] = counts[r] + edge[r, c]
+        for r in range(h):
+            rows[r, c] = counts[min(h, r + after + 1)] - \
+                counts[max(0, r - before)] > 0
+    for r in range(h):
+        counts[0] = 0
+        for c in range(w):
+            counts[c + 1] = counts[c] + rows[r, c]
+        for c in range(w):
+            out[r, c] = counts[min(w, c + after + 1)] - \
+                counts[max(0, c - before)] > 0
+
+
+@jit
+def _composite(edge, dilated_other, dilated_value, inv_edge, comp):
+    """inverted edge and the uint8 composite with the other dilated frame"""
+    h, w = edge.shape
+    for r in range(h):
+        for c in range(w):
+            inv = 0 if edge[r, c] else 255
+            inv_edge[r, c] = inv
+            if dilated_other[r, c]:
+                comp[r, c] = (inv + dilated_value) % 256  # uint8 wraps
+            else:
+                comp[r, c] = inv
+
+
+def _work_buffers(shape):
+    if not hasattr(_buffers, 'shapes'):
+        _buffers.shapes = dict()
+    if shape not in _buffers.shapes:
+        h, w = shape
+        f64 = [np.empty(shape, np.float64) for _ in xrange(6)]
+        _buffers.shapes[shape] = {
+            'float': f64,
+            'state': np.empty(shape, np.uint8),
+            'stack': np.empty(h * w, np.int64),
+            'edge': [np.empty(shape, np.bool_) for _ in xrange(2)],
+            'dilated': [np.empty(shape, np.bool_) for _ in xrange(3)],
+            'counts': np.empty(max(h, w) + 1, np.int64),
+            'uint8': [np.empty(shape, np.uint8) for _ in xrange(4)]}
+    return _buffers.shapes[shape]
+
+
+def edge_change_ratio(frame1, frame2, sigma=3, low_threshold=20,
+                      high_threshold=80, distance=24, edge_width=10,
+                      float_accuracy=3):
+    """
+    Calculate Edge Change Ratio for the given 2 frames (n-1, n), same
+    parameters and result as scene_cut_detect.edge_change_ratio
+    :return: Float
+    """
+    if not HAS_NUMBA:
+        return reference_edge_change_ratio(frame1, frame2, sigma,
+                                           low_threshold, high_threshold,
+                                           distance, edge_width,
+                                           float_accuracy)
+    buffers = _work_buffers(frame1.shape[:2])
+    weights = gaussian_kernel(sigma)
+    before, after, dilated_value = dilation_geometry(distance)
+    edge1, edge2 = buffers['edge']
+    for frame, edge in ((frame1, edge1), (frame2, edge2)):
+        _edge_map(np.ascontiguousarray(frame), weights,
+                  float(low_threshold), float(high_threshold),
+                  *(buffers['float'] + [buffers['state'], buffers['stack'],
+                                        edge]))
+
+    rows, frame1_dialate, frame2_dialate = buffers['dilated']
+    _dilate(edge1, before, after, buffers['counts'], rows, frame1_dialate)
+    _dilate(edge2, before, after, buffers['counts'], rows, frame2_dialate)
+
+    frame1_inv_edge, frame2_inv_edge, frame1_comp, frame2_comp = \
+        buffers['uint8']
+    _composite(edge1, frame2_dialate, dilated_value, frame1_inv_edge,
+               frame1_comp)
+    _composite(edge2, frame1_dialate, dilated_value, frame2_inv_edge,
+               frame2_comp)
+
+    frame1_contours = measure.find_contours(frame1_inv_edge, edge_width)
+    frame2_contours = measure.find_contours(frame2_inv_edge, edge_width)
+    frame1_comp_contours = measure.find_contours(frame1_comp, edge_width)
+    frame2_comp_contours = measure.find_contours(frame2_comp, edge_width)
+
+    try:
+        return round(
+            max(float(len(frame1_comp_contours)) / float(len(frame1_contours)),
+                float(len(frame2_comp_contours)) / float(len(frame2_contours))),
+            float_accuracy) * 100
+    except ZeroDivisionError:
+        return 0
+
+
+def edge_change_ratios(frames, threads=4, **kwargs):
+    """
+    Edge Change Ratio of every consecutive pair of frames on a thread pool,
+    the JIT kernels release the GIL so pairs run in parallel
+    :param frames: list of frames
+    :param threads: Number of threads
+    :return: list of Float, one per pair
+    """
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(lambda pair: edge_change_ratio(pair[0], pair[1],
+                                                       **kwargs),
+                        zip(frames[:-1], frames[1:]))
+    finally:
+        pool.close()
+
+
+def validate(frames, tolerance=0, **kwargs):
+    """
+    Compare this backend against the reference implementation
+    :param frames: iterable of frames, e.g. an ImgSeqStream of a test clip
+    :param tolerance: Allowed absolute ECR difference
+    :return: dict with pairs compared, mismatches and max difference
+    """
+    pairs, mismatches, max_difference = 0, 0, 0.0
+    previous_frame = None
+    for current_frame in frames:
+        if previous_frame is not None:
+            difference = abs(
+                edge_change_ratio(previous_frame, current_frame, **kwargs) -
+                reference_edge_change_ratio(previous_frame, current_frame,
+                                            **kwargs))
+            pairs += 1
+            mismatches += difference > tolerance
+            max_difference = max(max_difference, difference)
+        previous_frame = current_frame
+    return {'backend': 'numba' if HAS_NUMBA else 'reference',
+            'pairs': pairs,
+            'mismatches': mismatches,
+            'max_difference': max_difference}
+
+
+def synthetic_frames(count=8, shape=(216, 384), seed=0):
+    """
+    Frames with the cases the kernels have to get right: moving shapes and
+    text-like detail near the borders, sensor noise, flat and saturated
+    areas, colour casts, a cut to a new scene and a black frame
+    :return: list of uint8 (height, width, 3) ndarrays
+    """
+    random = np.random.RandomState(seed)
+    height, width = shape
+    rows, cols = np.mgrid[0:height, 0:width]
+    frames = list()
+    for n in xrange(count):
+        scene = n * 3 // count  # Two cuts along the sequence
+        frame = np.empty(shape + (3,), np.float64)
+        for channel in xrange(3):
+            frame[..., channel] = 40 + 30 * channel * scene + \
+                60 * np.sin((cols + 5 * n) / (17.0 + 11 * scene)) * \
+                np.cos(rows / (23.0 + 7 * channel))
+        shapes = np.random.RandomState(seed + scene)  # Same shapes per scene
+        for _ in xrange(6 + 4 * scene):
+            r, c = shapes.randint(0, height), shapes.randint(0, width) + 2 * n
+            size = shapes.randint(4, 40)
+            frame[max(r - size, 0):r + size, max(c - size, 0):c + 2 * size] = \
+                shapes.randint(0, 256, 3)
+        frame[:3, ::7] = 255  # Edges against the frame border
+        frame[:, -2:] = 0
+        frame += random.normal(0, 3, frame.shape)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    frames.append(np.zeros(shape + (3,), np.uint8))
+    return frames
+
+
+def parity_check(tolerance=0, **kwargs):
+    """
+    Validate this backend against the reference on synthetic_frames, with
+    the default and a smaller sigma and dilation distance
+    :return: list of validate dicts, one per parameter set
+    """
+    frames = synthetic_frames()
+    results = list()
+    for params in ({}, {'sigma': 1, 'distance': 8, 'edge_width': 10}):
+        params = dict(params, **kwargs)
+        result = validate(frames, tolerance, **params)
+        result['params'] = params
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    from scene_cut_detect import ImgSeqStream
+    if len(sys.argv) > 1:
+        # ecr_numba.py <image folder> <image name prefix> [fmt]
+        print validate(ImgSeqStream(*sys.argv[1:4]))
+    else:
+        results = parity_check()
+        for result in results:
+            print result
+        sys.exit(1 if any(result['mismatches'] for result in results) else 0)
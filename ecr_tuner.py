@@ -0,0 +1,212 @@
+"""
+Tune degradation, sigma, distance and edge_width of the Edge Change Ratio.
+
+Every configuration of a parameter grid is run over a few clips with known
+cuts, measuring throughput (frames/sec) and cut F1. Clips are streamed from
+the decoder once per degradation and every configuration scores each frame
+pair as it arrives, so memory does not grow with clip length. Throughput
+counts decoding, timed on its own pass over the clips, plus edge_change_ratio
+as if they did not overlap, a lower bound of what SCD_Using_ECR reaches. The
+Pareto front of speed against accuracy is reported and the most accurate
+configuration meeting a frames/sec target is saved as a named profile that
+SCD_Using_ECR(profile=name) loads.
+"""
+from os import getcwd
+from os.path import basename, join as pathjoin, splitext
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+from itertools import product
+import argparse
+from ffmpeg_utils import video_to_images
+from scene_cut_detect import ImgSeqStream, get_ecr_backend, save_profile, \
+    PROFILES_FILE
+
+DEFAULT_GRID = {'degradation': [2, 4, 5, 8],
+                'sigma': [1, 2, 3],
+                'distance': [8, 16, 24],
+                'edge_width': [10]}
+
+
+def load_cuts(cuts_file):
+    """Ground truth cut frame numbers, one per line, # for comments"""
+    with open(cuts_file) as fp:
+        return sorted(int(line.split('#')[0]) for line in fp
+                      if line.split('#')[0].strip())
+
+
+def clip_frames(video, degradation, tmp_path=getcwd(), fmt='_%05d.jpg'):
+    """Frames of a clip at a degradation, a generator fed by the decoder"""
+    tmp_folder = mkdtemp(dir=tmp_path)
+    tmp_filename = splitext(basename(video))[0]
+    decoder = video_to_images(video, pathjoin(tmp_folder, tmp_filename), fmt,
+                              degradation, wait=False)
+    try:
+        for frame in ImgSeqStream(tmp_folder, tmp_filename, fmt, decoder):
+            yield frame
+        if decoder.wait() != 0:
+            raise IOError('FFMPEG failed to decode %s' % video)
+    finally:
+        decoder.stop()
+        rmtree(tmp_folder, True)
+
+
+def f1_score(detected, truth, tolerance=1):
+    """
+    F1 of detected cut frames against the ground truth
+    :param tolerance: Frames a detection may be off by
+    :return: tuple (precision, recall, f1)
+    """
+    unmatched = list(truth)
+    hits = 0
+    for cut in detected:
+        match = [t for t in unmatched if abs(t - cut) <= tolerance]
+        if match:
+            unmatched.remove(min(match, key=lambda t: abs(t - cut)))
+            hits += 1
+    precision = float(hits) / len(detected) if detected else 1.0
+    recall = float(hits) / len(truth) if truth else 1.0
+    if precision + recall == 0:
+        return precision, recall, 0.0
+    return precision, recall, 2 * precision * recall / (precision + recall)
+
+
+def benchmark(clips, grid=DEFAULT_GRID, global_threshold=80, tolerance=1,
+              backend='numpy', tmp_path=getcwd()):
+    """
+    Run every grid configuration over the clips
+    :param clips: list of (video, list of cut frame numbers)
+    :param grid: dict of parameter name to the values to try
+    :return: list of result dicts (the configuration, fps and f1), fps
+             is decoding plus edge_change_ratio, also given apart as
+             decode_fps and ecr_fps
+    """
+    ecr_function = get_ecr_backend(backend)
+    configs = list(product(grid['sigma'], grid['distance'],
+                           grid['edge_width']))
+    results = list()
+    for degradation in grid['degradation']:
+        frames = 0
+        decode_elapsed = 0.0
+        elapsed = dict((config, 0.0) for config in configs)
+        hits = dict((config, list()) for config in configs)
+        for video, cuts in clips:
+            start = time()
+            for _ in clip_frames(video, degradation, tmp_path):
+                pass
+            decode_elapsed += time() - start
+            detected = dict((config, list()) for config in configs)
+            previous_frame = None
+            for i, current_frame in enumerate(clip_frames(video, degradation,
+                                                          tmp_path)):
+                if previous_frame is not None:
+                    frames += 1
+                    for config in configs:
+                        sigma, distance, edge_width = config
+                        start = time()
+                        ecr = ecr_function(previous_frame, current_frame,
+                                           sigma=sigma, distance=distance,
+                                           edge_width=edge_width,
+                                           float_accuracy=2)
+                        elapsed[config] += time() - start
+                        if ecr > global_threshold:
+                            detected[config].append(i)
+                previous_frame = current_frame
+            for config in configs:
+                hits[config].append(f1_score(detected[config], cuts,
+                                             tolerance))
+        for config in configs:
+            sigma, distance, edge_width = config
+            scores = hits[config]
+            total = decode_elapsed + elapsed[config]
+            result = {'degradation': degradation, 'sigma': sigma,
+                      'distance': distance, 'edge_width': edge_width,
+                      'global_threshold': global_threshold,
+                      'fps': frames / total if total else float('inf'),
+                      'decode_fps': frames / decode_elapsed
+                      if decode_elapsed else float('inf'),
+                      'ecr_fps': frames / elapsed[config]
+                      if elapsed[config] else float('inf'),
+                      'precision': sum(h[0] for h in scores) / len(scores),
+                      'recall': sum(h[1] for h in scores) / len(scores),
+                      'f1': sum(h[2] for h in scores) / len(scores)}
+            print result
+            results.append(result)
+    return results
+
+
+def pareto_front(results):
+    """Results no other result beats on both fps and f1, fastest first"""
+    front = [r for r in results
+             if not any(o['fps'] >= r['fps'] and o['f1'] >= r['f1'] and
+                        (o['fps'] > r['fps'] or o['f1'] > r['f1'])
+                        for o in results)]
+    return sorted(front, key=lambda r: -r['fps'])
+
+
+def best_for_fps(results, fps_target):
+    """Most accurate result at or above fps_target, the fastest on ties"""
+    fast_enough = [r for r in results if r['fps'] >= fps_target]
+    if not fast_enough:
+        return None
+    return max(fast_enough, key=lambda r: (r['f1'], r['fps']))
+
+
+def tune(clips, fps_target, profile, grid=DEFAULT_GRID, global_threshold=80,
+         tolerance=1, backend='numpy', profiles_file=PROFILES_FILE,
+         tmp_path=getcwd()):
+    """
+    Benchmark the grid, print the Pareto front and save the best profile
+    :param clips: list of (video, list of cut frame numbers)
+    :param fps_target: Minimum frames/sec, decoding included
+    :param profile: Name to save the chosen configuration under
+    :return: The chosen result dict or None if nothing reaches fps_target
+    """
+    results = benchmark(clips, grid, global_threshold, tolerance, backend,
+                        tmp_path)
+    print 'Pareto front (fps, f1):'
+    for r in pareto_front(results):
+        print '  {fps:8.2f} {f1:.3f}  degradation={degradation} ' \
+              'sigma={sigma} distance={distance} ' \
+              'edge_width={edge_width}'.format(**r)
+    best = best_for_fps(results, fps_target)
+    if best is None:
+        print 'No configuration reaches', fps_target, 'fps'
+        return None
+    save_profile(profile, dict((key, best[key]) for key in (
+        'degradation', 'sigma', 'distance', 'edge_width', 'global_threshold',
+        'fps', 'f1')), profiles_file)
+    print 'Saved profile', profile, best
+    return best
+
+
+def _values(text):
+    """Comma separated grid values, e.g 1,1.5,2"""
+    values = [float(v) for v in text.split(',')]
+    return [int(v) if v == int(v) else v for v in values]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clip', nargs=2, action='append', required=True,
+                        metavar=('VIDEO', 'CUTS'),
+                        help='Clip and its file of cut frame numbers')
+    parser.add_argument('--fps-target', type=float, required=True)
+    parser.add_argument('--profile', required=True)
+    parser.add_argument('--profiles-file', default=PROFILES_FILE)
+    parser.add_argument('--threshold', type=float, default=80)
+    parser.add_argument('--tolerance', type=int, default=1)
+    parser.add_argument('--backend', default='numpy')
+    parser.add_argument('--tmp-path', default=getcwd())
+    for key, values in sorted(DEFAULT_GRID.items()):
+        parser.add_argument('--' + key.replace('_', '-'), type=_values,
+                            default=values, dest=key)
+    args = parser.parse_args()
+    grid = dict((key, getattr(args, key)) for key in DEFAULT_GRID)
+    clips = [(video, load_cuts(cuts)) for video, cuts in args.clip]
+    tune(clips, args.fps_target, args.profile, grid, args.threshold,
+         args.tolerance, args.backend, args.profiles_file, args.tmp_path)
+
+
+if __name__ == '__main__':
+    main()
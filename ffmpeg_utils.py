@@ -1,7 +1,10 @@
 from timecode_utils import convert_timecode, timecode_to_seconds
 from timecode_utils import seconds_to_frames
 from platform import system
+from math import ceil
+from fractions import Fraction
 from time import sleep
+from threading import Thread
 # from PIL import Image
 # from os.path import basename, join as pathjoin
 # from os import getcwd, sep, makedirs
@@ -265,7 +268,7 @@ def get_pixel_formats():
 def ffprobe_vdata(video):
     ffprobe_bin = get_ffprobe_bin()
     cmd = [ffprobe_bin,
-           '-select_streams', 'v',
+           '-select_streams', 'v:0',
            '-show_streams',
            video]
     pipe = sp.Popen(cmd, stdout=sp.PIPE, close_fds=True)
@@ -275,6 +278,22 @@ def ffprobe_vdata(video):
     return data
 
 
+def exact_frame_rate(video, fps=0):
+    """
+    Exact frame rate of a Video's stream, ffprobe_video's fps is rounded for
+    display (23.98 for 24000/1001) and drifts a frame every 2000 frames
+    :param video: Path to Video
+    :param fps: Rounded frame rate used if ffprobe reports no rate
+    :return: Fraction
+    """
+    data = ffprobe_vdata(video)
+    for key in ('r_frame_rate', 'avg_frame_rate'):
+        num, _, den = data.get(key, '0/0').partition('/')
+        if int(num or 0) and int(den or 1):
+            return Fraction(int(num), int(den or 1))
+    return Fraction(str(fps))
+
+
 def ffprobe_video(video):
     """
     Get Video's Video Information using FFPROBE
@@ -300,7 +319,8 @@ def ffprobe_video(video):
     # duration = convert_timecode(fps, duration)
     total_seconds = timecode_to_seconds(duration, fps)
     width, height = [int(i) for i in frame_size.split('x')]
-    total_frames = seconds_to_frames(total_seconds, fps)
+    frame_rate = exact_frame_rate(video, fps)
+    total_frames = seconds_to_frames(total_seconds, frame_rate)
     is_even = total_frames % 2 == 0
     is_odd = is_even == False
     pipe.terminate()
@@ -313,21 +333,136 @@ def ffprobe_video(video):
             'frames': total_frames,
             'is_even': is_even,
             'is_odd': is_odd,
-            'fps': fps}
+            'fps': fps,
+            'frame_rate': frame_rate}
+
+
+def cropdetect(video, seek=None, frame_count=25, limit=24, round_to=2):
+    """
+    Active picture area (without letterbox/pillarbox bars) using FFMPEG's
+    cropdetect filter over frame_count frames from seek
+    :param video: Path to Video
+    :param seek: Position in seconds
+    :param limit: Black level threshold 0-255
+    :param round_to: Round width/height to a multiple of this
+    :return: tuple (width, height, x, y) or None if nothing was detected
+    """
+    cmd = []
+    if seek:
+        cmd += ['-ss', '%.6f' % seek]
+    cmd += ['-i', video, '-an', '-vframes', str(frame_count), '-vf',
+            'cropdetect=%d:%d:0' % (limit, round_to), '-f', 'null', '-']
+    stdout, stderr = get_ffmpeg(cmd).communicate()
+    crop = None
+    for line in stderr.split('\n'):
+        if 'crop=' in line:  # Each line covers all frames seen so far
+            crop = [int(v) for v in line.split('crop=')[1].split(':')]
+    if crop is None or crop[0] <= 0 or crop[1] <= 0:
+        return None  # All black samples report an empty area
+    return tuple(crop)
+
+
+def detect_active_area(video, video_info, recheck_seconds=300,
+                       frame_count=25, limit=24, first_frame=0,
+                       last_frame=None):
+    """
+    Active picture area of a Video or of frames [first_frame, last_frame),
+    cropdetect is re-run every recheck_seconds and the union of the areas is
+    returned so a change of aspect ratio along the Video never crops picture
+    :param video: Path to Video
+    :param video_info: ffprobe_video dict
+    :param first_frame: First frame of the range to scan
+    :param last_frame: Last frame (exclusive), None for end of Video
+    :return: tuple (width, height, x, y) or None when no bars were found
+    """
+    fps = float(video_info['frame_rate'])
+    start = first_frame / fps
+    end = video_info['seconds']
+    if last_frame is not None:
+        end = min(last_frame / fps, end)
+    seconds = max(end - start, 0)
+    samples = max(1, int(ceil(seconds / float(recheck_seconds))))
+    step = seconds / float(samples)
+    areas = [cropdetect(video, start + step * (k + 0.5), frame_count, limit)
+             for k in xrange(samples)]
+    areas = [area for area in areas if area is not None]
+    if not areas:
+        return None
+    x0 = min(x for w, h, x, y in areas)
+    y0 = min(y for w, h, x, y in areas)
+    x1 = max(x + w for w, h, x, y in areas)
+    y1 = max(y + h for w, h, x, y in areas)
+    if (x1 - x0, y1 - y0) == (video_info['width'], video_info['height']):
+        return None  # Full frame, nothing to crop
+    return x1 - x0, y1 - y0, x0, y0
+
+
+class BackgroundFFMPEG(object):
+    """
+    A running FFMPEG whose output pipes are drained by a thread so it never
+    blocks on a full pipe, and whose exit code is only ever read by that
+    thread (a second waitpid may take the status and report success)
+    """
+    def __init__(self, process):
+        self.process = process
+        self.output = None
+        self.thread = Thread(target=self._drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _drain(self):
+        self.output = self.process.communicate()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def wait(self):
+        """Wait for FFMPEG to exit, return its exit code"""
+        self.thread.join()
+        return self.process.returncode
+
+    def stop(self):
+        """Kill FFMPEG if it is still running"""
+        if self.running():
+            try:
+                self.process.kill()
+            except OSError:
+                pass  # Exited meanwhile
+        return self.wait()
 
 
 def video_to_images(input_video, output_file, fmt='_%05d.jpg', degradation=5,
-                    wait=True):
-    x = get_ffmpeg(['-i', input_video, '-deinterlace', '-an', '-vf',
-                    'scale=iw/%s:-1' % degradation,
-                    '-f', 'image2', output_file + fmt])
+                    wait=True, seek=None, frame_count=None, crop=None):
+    """
+    Extract a Video to an Image Sequence using FFMPEG
+    :param input_video: Path to Video
+    :param output_file: Path and name prefix of the Images
+    :param fmt: Image sequence number format and extension
+    :param degradation: Scale down factor
+    :param wait: Block until FFMPEG is done
+    :param seek: Start position in seconds (input seek, before -i)
+    :param frame_count: Number of frames to extract
+    :param crop: tuple (width, height, x, y) to crop before scaling
+    :return: Bool if wait else the BackgroundFFMPEG still writing Images
+    """
+    video_filter = 'scale=iw/%s:-1' % degradation
+    if crop:
+        video_filter = 'crop=%d:%d:%d:%d,' % tuple(crop) + video_filter
+    cmd = []
+    if seek:
+        cmd += ['-ss', '%.6f' % seek]
+    cmd += ['-i', input_video, '-deinterlace', '-an', '-vf', video_filter]
+    if frame_count is not None:
+        cmd += ['-vframes', str(frame_count)]
+    cmd += ['-f', 'image2', output_file + fmt]
+    x = get_ffmpeg(cmd)
     if wait:
         while x.returncode != 0:
             sleep(1)
             x.communicate()
         return x.returncode == 0
     else:
-        sleep(0.1)
+        return BackgroundFFMPEG(x)
 
 
 #Depreciated function
@@ -2,14 +2,22 @@ from matplotlib import colors
 from skimage.filter import canny
 from skimage import measure
 from skimage.morphology import dilation, square
-from os import getcwd
+from os import getcwd, remove, rename
 from os.path import basename, join as pathjoin, splitext, isfile
 from PIL import Image
 from tempfile import mkdtemp
 from shutil import rmtree
-from ffmpeg_utils import ffprobe_video, video_to_images
+from time import time, sleep
+from functools import partial
+from fractions import Fraction
+from scipy.stats import norm
+from ffmpeg_utils import ffprobe_video, video_to_images, detect_active_area
 from pytimecode import PyTimeCode
+from shot_thumbnails import ShotThumbnailer
+from shot_index import write_index, index_path
+from timecode_utils import nominal_rate, timecode_to_frames
 import numpy as np
+import json
 
 
 def invert(image):
@@ -107,69 +115,875 @@ def edge_change_ratio(frame1, frame2, sigma=3, low_threshold=20,
         return 0
 
 
-def ImgSeqStream(path, filename, fmt='_%05d.jpg'):
+class TiledContourCounter(object):
+    """
+    Count the contours of an image fed as horizontal tiles that share one
+    row with the next tile. A contour crossing a shared row is split into
+    pieces ending on the same point of that row, pieces are joined there.
+    """
+    def __init__(self, level):
+        self.level = level
+        self.parent = list()
+        self.ends = dict()
+
+    def find(self, piece):
+        while self.parent[piece] != piece:
+            self.parent[piece] = self.parent[self.parent[piece]]
+            piece = self.parent[piece]
+        return piece
+
+    def add(self, first_row, tile):
+        for contour in measure.find_contours(tile, self.level):
+            piece = len(self.parent)
+            self.parent.append(piece)
+            for r, c in (contour[0], contour[-1]):
+                key = (round(r + first_row, 6), round(c, 6))
+                if key in self.ends:
+                    self.parent[self.find(piece)] = self.find(self.ends[key])
+                else:
+                    self.ends[key] = piece
+
+    def count(self):
+        return sum(1 for piece in xrange(len(self.parent))
+                   if self.find(piece) == piece)
+
+
+def ecr_halo(sigma=3, distance=24):
+    """
+    Rows of context a tile needs on each side: the gaussian radius, sobel
+    and non maximum suppression, and the dilation distance
+    """
+    return int(4.0 * sigma + 0.5) + 2 + distance
+
+
+def edge_change_ratio_tiled(frame1, frame2, sigma=3, low_threshold=20,
+                            high_threshold=80, distance=24, edge_width=10,
+                            float_accuracy=3, tile_rows=256,
+                            hysteresis_rows=48):
+    """
+    Calculate Edge Change Ratio for the given 2 frames (n-1, n) in stripes of
+    tile_rows plus a halo, peak memory is bounded by the stripe not the frame.
+    Canny hysteresis chains reaching further than hysteresis_rows past the
+    halo may differ from edge_change_ratio, otherwise the score is the same.
+    :param tile_rows: Rows per stripe
+    :param hysteresis_rows: Extra halo rows for canny hysteresis
+    :return: Float
+    """
+    height = frame1.shape[0]
+    halo = ecr_halo(sigma, distance) + hysteresis_rows
+    counters = [TiledContourCounter(edge_width) for _ in xrange(4)]
+    for top in xrange(0, max(height - 1, 1), tile_rows):
+        bottom = min(top + tile_rows + 1, height)  # Share a row with next
+        first = max(top - halo, 0)
+        last = min(bottom + halo, height)
+        core = slice(top - first, bottom - first)
+
+        frame1_edge = canny(desaturate(frame1[first:last]), sigma,
+                            low_threshold, high_threshold)
+        frame2_edge = canny(desaturate(frame2[first:last]), sigma,
+                            low_threshold, high_threshold)
+
+        frame1_inv_edge = invert(frame1_edge).astype('uint8') * 255
+        frame2_inv_edge = invert(frame2_edge).astype('uint8') * 255
+
+        frame1_dialate = dilation(frame1_edge, square(distance))
+        frame2_dialate = dilation(frame2_edge, square(distance))
+
+        frame1_comp = frame1_inv_edge + frame2_dialate
+        frame2_comp = frame2_inv_edge + frame1_dialate
+
+        for counter, tile in zip(counters, (frame1_inv_edge, frame2_inv_edge,
+                                            frame1_comp, frame2_comp)):
+            counter.add(top, tile[core])
+
+    frame1_contours, frame2_contours, frame1_comp_contours, \
+        frame2_comp_contours = [counter.count() for counter in counters]
+    try:
+        return round(
+            max(float(frame1_comp_contours) / float(frame1_contours),
+                float(frame2_comp_contours) / float(frame2_contours)),
+            float_accuracy) * 100
+    except ZeroDivisionError:
+        return 0
+
+
+def stripe_stages(edge, top, bottom, distance=24):
+    """
+    Inverted edges and dilation of the rows [top, bottom) of a frame from its
+    whole frame canny edges, the dilation only needs distance // 2 rows of
+    context around them
+    :return: tuple (inverted edges, dilated edges)
+    """
+    reach = distance // 2 + 1
+    first, last = max(top - reach, 0), min(bottom + reach, edge.shape[0])
+    inv_edge = invert(edge[top:bottom]).astype('uint8') * 255
+    dialate = dilation(edge[first:last], square(distance))
+    return inv_edge, dialate[top - first:bottom - first]
+
+
+def stripe_count(contours, top):
+    """
+    Contours of a stripe counted towards the frame: a piece running on above
+    the stripe is part of a contour the stripe above counts. A contour
+    leaving the stripe below more than once counts more than once, the pooled
+    stripe variance of SampledECR takes that in.
+    """
+    if not top:
+        return len(contours)
+    return sum(1 for contour in contours
+               if contour[0][0] != 0 and contour[-1][0] != 0)
+
+
+class SampledECR(object):
+    """
+    Approximate Edge Change Ratio from a sample of full width stripes of each
+    frame pair. Canny runs once on the whole frame, a stripe is inverted,
+    dilated and searched for contours on its own rows, it shares its last
+    row with the next stripe as in edge_change_ratio_tiled. Each frame's
+    contour ratio is a ratio estimate over the sampled stripes. A pair
+    samples too few stripes to estimate their variance, so their dispersion
+    around the ratio, relative to Poisson counts, is pooled over every pair
+    sampled so far. A sample only ever rules a CUT! out: until min_stripes
+    stripes are pooled, and whenever the upper bound of the ECR reaches the
+    threshold, the pair is scored in full, so every CUT! is an exact score.
+    The stages of a frame (edges, inverted edges, their contours and the
+    dilation) are kept for the next pair, so a run of escalated pairs
+    computes each frame once, with edge_change_ratio's score.
+    """
+    def __init__(self, global_threshold=80, sample_fraction=0.25,
+                 confidence=0.99, sampling='stratified', stripe_rows=32,
+                 full_ecr=edge_change_ratio, seed=None, min_stripes=16,
+                 sigma=3, low_threshold=20, high_threshold=80, distance=24,
+                 edge_width=10):
+        """
+        :param global_threshold: CUT! threshold of the upper bound
+        :param sample_fraction: Fraction of stripes scored per frame pair, all
+                                of them (1) scores every pair with full_ecr
+        :param confidence: Confidence level of the upper bound
+        :param sampling: 'random' or 'stratified' (one stripe per stratum)
+        :param stripe_rows: Stripe height in rows
+        :param full_ecr: Full frame edge_change_ratio used to escalate, the
+                         numpy reference is computed from the kept stages
+        :param seed: Seed of the stripe sampler
+        :param min_stripes: Stripes pooled before a sample is trusted
+        """
+        self.global_threshold = global_threshold
+        self.sample_fraction = sample_fraction
+        self.z = norm.ppf(confidence)  # One sided
+        self.sampling = sampling
+        self.stripe_rows = stripe_rows
+        self.full_ecr = full_ecr
+        self.random = np.random.RandomState(seed)
+        self.min_stripes = min_stripes
+        self.params = {'sigma': sigma, 'low_threshold': low_threshold,
+                       'high_threshold': high_threshold, 'distance': distance,
+                       'edge_width': edge_width}
+        self.frame, self.stages = None, None
+        self.pooled_stripes = 0
+        self.pooled_residuals = 0.0
+        self.pooled_variance = 0.0
+        self.pairs = 0
+        self.escalations = 0
+
+    def sample(self, total):
+        """Pick stripe numbers out of total, sorted"""
+        n = min(max(int(np.ceil(self.sample_fraction * total)), 2), total)
+        if self.sampling == 'stratified':
+            strata = np.array_split(np.arange(total), n)
+            return [self.random.choice(stratum) for stratum in strata]
+        return sorted(self.random.choice(total, n, replace=False))
+
+    def frame_stages(self, frame):
+        """Stages of a frame, the last frame's are kept for the next pair"""
+        if frame is not self.frame:
+            self.frame = frame
+            self.stages = {'edge': canny(desaturate(frame),
+                                         self.params['sigma'],
+                                         self.params['low_threshold'],
+                                         self.params['high_threshold'])}
+        return self.stages
+
+    def full_stages(self, stages):
+        """Add the whole frame stages edge_change_ratio needs"""
+        if 'dialate' not in stages:
+            stages['inv_edge'] = invert(stages['edge']).astype('uint8') * 255
+            stages['contours'] = len(measure.find_contours(
+                stages['inv_edge'], self.params['edge_width']))
+            stages['dialate'] = dilation(stages['edge'],
+                                         square(self.params['distance']))
+        return stages
+
+    def stripe_counts(self, stages1, stages2, top, height):
+        """
+        Stripe contour counts of frame1, frame2, frame1 composite and frame2
+        composite, from the whole frame stages when a frame has them
+        """
+        bottom = min(top + self.stripe_rows + 1, height)  # Share a row
+        stripes = list()
+        for stages in (stages1, stages2):
+            if 'dialate' in stages:
+                stripes.append((stages['inv_edge'][top:bottom],
+                                stages['dialate'][top:bottom]))
+            else:
+                stripes.append(stripe_stages(stages['edge'], top, bottom,
+                                             self.params['distance']))
+        (frame1_inv_edge, frame1_dialate), \
+            (frame2_inv_edge, frame2_dialate) = stripes
+        return [stripe_count(measure.find_contours(
+                    image, self.params['edge_width']), top)
+                for image in (frame1_inv_edge, frame2_inv_edge,
+                              frame1_inv_edge + frame2_dialate,
+                              frame2_inv_edge + frame1_dialate)]
+
+    def contour_ratio(self, comp_counts, counts, total):
+        """
+        Ratio estimate of one frame's composite to edge contours and its
+        upper bound from the pooled dispersion, see pool. The variance is the
+        one of a ratio at the threshold, a sample without composite contours
+        does not make a frame certain.
+        :return: tuple (estimate, upper bound)
+        """
+        if not counts.sum():
+            return 0.0, np.inf  # Contours may be outside the sample
+        ratio = float(comp_counts.sum()) / counts.sum()
+        threshold = self.global_threshold / 100.0
+        dispersion = self.pooled_residuals / self.pooled_variance
+        variance = (1.0 - float(len(counts)) / total) * dispersion * \
+            threshold * (1.0 + threshold) / counts.sum()
+        return ratio, ratio + self.z * np.sqrt(variance)
+
+    def pool(self, comp_counts, counts):
+        """
+        Pool the squared residuals of one frame's sampled stripes around its
+        ratio, against their variance were the counts Poisson
+        """
+        n = len(counts)
+        if not counts.sum():
+            return
+        ratio = float(comp_counts.sum()) / counts.sum()
+        self.pooled_residuals += ((comp_counts - ratio * counts) ** 2).sum() \
+            * n / (n - 1.0)
+        self.pooled_variance += comp_counts.sum() + ratio ** 2 * counts.sum()
+
+    def full_ratio(self, stages1, stages2, float_accuracy):
+        """edge_change_ratio from the whole frame stages"""
+        stages1, stages2 = self.full_stages(stages1), self.full_stages(stages2)
+        frame1_comp = stages1['inv_edge'] + stages2['dialate']
+        frame2_comp = stages2['inv_edge'] + stages1['dialate']
+        frame1_comp_contours = measure.find_contours(
+            frame1_comp, self.params['edge_width'])
+        frame2_comp_contours = measure.find_contours(
+            frame2_comp, self.params['edge_width'])
+        try:
+            return round(
+                max(float(len(frame1_comp_contours)) / stages1['contours'],
+                    float(len(frame2_comp_contours)) / stages2['contours']),
+                float_accuracy) * 100
+        except ZeroDivisionError:
+            return 0
+
+    def __call__(self, frame1, frame2, float_accuracy=3):
+        self.pairs += 1
+        height = frame1.shape[0]
+        tops = range(0, max(height - 1, 1), self.stripe_rows)
+        picks = self.sample(len(tops))
+        if len(picks) == len(tops):
+            return self.full_ecr(frame1, frame2, float_accuracy=float_accuracy,
+                                 **self.params)
+        stages1, stages2 = self.frame_stages(frame1), self.frame_stages(frame2)
+        counts = np.array([self.stripe_counts(stages1, stages2, tops[i],
+                                              height)
+                           for i in picks], float)
+        trusted = self.pooled_stripes >= self.min_stripes and \
+            self.pooled_variance
+        for frame in (0, 1):
+            self.pool(counts[:, frame + 2], counts[:, frame])
+        self.pooled_stripes += len(picks)
+        if trusted:
+            ratio1, high1 = self.contour_ratio(counts[:, 2], counts[:, 0],
+                                               len(tops))
+            ratio2, high2 = self.contour_ratio(counts[:, 3], counts[:, 1],
+                                               len(tops))
+            if max(high1, high2) * 100 < self.global_threshold:
+                return round(max(ratio1, ratio2), float_accuracy) * 100
+        self.escalations += 1
+        if self.full_ecr is not edge_change_ratio:
+            return self.full_ecr(frame1, frame2, float_accuracy=float_accuracy,
+                                 **self.params)
+        return self.full_ratio(stages1, stages2, float_accuracy)
+
+    def checkpoint(self):
+        """
+        :return: dict of the pooled dispersion, counters and sampler state to
+                 resume with, see restore
+        """
+        name, keys, position, has_gauss, gauss = self.random.get_state()
+        return {'pooled_stripes': self.pooled_stripes,
+                'pooled_residuals': self.pooled_residuals,
+                'pooled_variance': self.pooled_variance,
+                'pairs': self.pairs, 'escalations': self.escalations,
+                'random': [name, keys.tolist(), position, has_gauss, gauss]}
+
+    def restore(self, state):
+        """Continue from a checkpoint(), a resumed run samples the same"""
+        self.pooled_stripes = state['pooled_stripes']
+        self.pooled_residuals = state['pooled_residuals']
+        self.pooled_variance = state['pooled_variance']
+        self.pairs, self.escalations = state['pairs'], state['escalations']
+        name, keys, position, has_gauss, gauss = state['random']
+        self.random.set_state((str(name), np.array(keys, 'uint32'), position,
+                               has_gauss, gauss))
+
+    def report(self):
+        return {'sampled_pairs': self.pairs,
+                'escalations': self.escalations,
+                'escalation_rate': round(
+                    float(self.escalations) / max(self.pairs, 1), 4)}
+
+
+def benchmark_sampled(frames, sample_fraction=0.25, confidence=0.99,
+                      global_threshold=80, seed=0, **kwargs):
+    """
+    Time SampledECR against edge_change_ratio over consecutive frame pairs
+    :param frames: list of frames, e.g pan_frames() or decoded Images
+    :return: dict of seconds per pair of both, the speedup, the escalation
+             report and the pairs whose CUT! decision differs
+    """
+    pairs = zip(frames[:-1], frames[1:])
+    start = time()
+    full = [edge_change_ratio(frame1, frame2, **kwargs)
+            for frame1, frame2 in pairs]
+    full_seconds = time() - start
+    sampled_ecr = SampledECR(global_threshold, sample_fraction, confidence,
+                             seed=seed, **kwargs)
+    start = time()
+    sampled = [sampled_ecr(frame1, frame2) for frame1, frame2 in pairs]
+    sampled_seconds = time() - start
+    result = {'pairs': len(pairs), 'sample_fraction': sample_fraction,
+              'full_seconds': round(full_seconds / len(pairs), 4),
+              'sampled_seconds': round(sampled_seconds / len(pairs), 4),
+              'speedup': round(full_seconds / sampled_seconds, 2),
+              'decisions_differ': [
+                  i for i, (ecr, approx) in enumerate(zip(full, sampled), 1)
+                  if (ecr > global_threshold) != (approx > global_threshold)]}
+    result.update(sampled_ecr.report())
+    return result
+
+
+def pan_frames(shape=(216, 384), shot_frames=8, step=1.0, seed=0):
+    """
+    Slow pans over skimage's sample photos with sensor noise, a cut between
+    photos, footage-like frames for benchmark_sampled
+    :return: list of uint8 (height, width, 3) ndarrays
+    """
+    from skimage import data, transform
+    random = np.random.RandomState(seed)
+    height, width = shape
+    frames = list()
+    for name in ('chelsea', 'coffee', 'hubble_deep_field',
+                 'immunohistochemistry', 'camera', 'coins'):
+        photo = getattr(data, name)()
+        if photo.ndim == 2:
+            photo = np.dstack([photo] * 3)
+        photo = transform.resize(photo, (int(height * 1.1), int(width * 1.1)))
+        for n in xrange(shot_frames):
+            frame = transform.warp(photo, transform.AffineTransform(
+                translation=(n * step, n * step / 2.0)),
+                output_shape=shape) * 255
+            frame += random.normal(0, 2, frame.shape)
+            frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+
+def frame_fingerprint(frame, size=16):
+    """
+    Cheap fingerprint of a frame, the mean level of each cell of a
+    size x size grid
+    :param frame: 3D ndarray
+    :return: 2D float32 ndarray
+    """
+    height, width = frame.shape[:2]
+    rows, cols = max(height // size, 1), max(width // size, 1)
+    grid_height, grid_width = min(size, height), min(size, width)
+    cells = frame[:grid_height * rows, :grid_width * cols].astype('float32')
+    cells = cells.reshape(grid_height, rows, grid_width, cols, -1)
+    return cells.mean(axis=4).mean(axis=3).mean(axis=1)
+
+
+def is_static(fingerprint1, fingerprint2, tolerance=1.0):
+    """
+    Frames of two fingerprints are identical or nearly so (slates, black,
+    freeze frames, holds)
+    :param tolerance: Largest allowed cell level difference
+    :return: Bool
+    """
+    return fingerprint1 is not None and fingerprint2 is not None and \
+        np.abs(fingerprint1 - fingerprint2).max() <= tolerance
+
+
+def ImgSeqStream(path, filename, fmt='_%05d.jpg', decoder=None, poll=0.1):
+    """
+    Frames of an Image Sequence as ndarrays
+    :param decoder: BackgroundFFMPEG still writing the sequence, an Image is
+                    read once the next one exists or the decoder has exited
+    :param poll: Seconds between checks for the decoder's next Image
+    """
     digits = len(fmt % 1)
     max_number = int('9' * digits)
     for i in xrange(1, max_number):
         imgfile = pathjoin(path, filename + fmt % i)
+        while decoder is not None and decoder.running() and \
+                not isfile(pathjoin(path, filename + fmt % (i + 1))):
+            sleep(poll)
         if not isfile(imgfile):
             break
             # raise IOError(imgfile + ' Not found!')
         else:
-            with open(imgfile) as fp:
-                img = Image.open(fp)
-                pix = np.array(img.getdata(), dtype=np.uint8).reshape(
-                    (img.size[1], img.size[0], 3))
-                yield pix
+            yield read_image(imgfile)
+
+
+def read_image(imgfile):
+    """Image file as a (height, width, 3) uint8 ndarray"""
+    with open(imgfile) as fp:
+        img = Image.open(fp)
+        pix = np.array(img.getdata(), dtype=np.uint8).reshape(
+            (img.size[1], img.size[0], 3))
+    return pix
+
+
+def log_line(timecode, frame, ecr, cut=False):
+    """
+    Format a line of the Scene Cut Detection log
+    :param timecode: Source running timecode
+    :param frame: Frame number
+    :param ecr: Edge Change Ratio
+    :param cut: Mark the frame as a CUT!
+    :return: String
+    """
+    if cut:
+        return '{2},{0},{1},CUT!\n'.format(frame, ecr, timecode)
+    return '{2},{0},{1}\n'.format(frame, ecr, timecode)
+
+
+def parse_log_line(line):
+    """
+    Parse a line of the Scene Cut Detection log
+    :param line: String written by log_line
+    :return: tuple (timecode, frame number, ecr, cut)
+    """
+    fields = line.strip().split(',')
+    return fields[0], int(fields[1]), float(fields[2]), fields[3:] == ['CUT!']
+
+
+def get_ecr_backend(backend='numpy', tile_rows=None):
+    """
+    Get the edge_change_ratio implementation of a backend
+    :param backend: 'numpy' reference or 'numba' JIT (falls back to numpy)
+    :param tile_rows: Score in stripes of tile_rows, see
+                      edge_change_ratio_tiled (uses the numpy stages)
+    :return: function
+    """
+    if tile_rows:
+        return partial(edge_change_ratio_tiled, tile_rows=tile_rows)
+    if backend == 'numba':
+        from ecr_numba import edge_change_ratio as jit_edge_change_ratio
+        return jit_edge_change_ratio
+    return edge_change_ratio
+
+
+def decode_range(video, output_path, frame_rate, first_frame=0,
+                 last_frame=None, pre_roll=True, fmt='_%05d.jpg',
+                 degradation=5, crop=None):
+    """
+    Start decoding frames [first_frame, last_frame) of a Video to Images,
+    seeking to one pre-roll frame before first_frame for the first comparison
+    :param output_path: Path and name prefix of the Images
+    :param frame_rate: Exact Video frame rate, ffprobe_video's 'frame_rate'
+                       (seeking with the rounded 'fps' lands on wrong frames)
+    :param last_frame: Last frame number (exclusive), None for end of Video
+    :param pre_roll: Decode the frame before first_frame as well
+    :param crop: Decode only (width, height, x, y)
+    :return: tuple (frame number of the first Image, BackgroundFFMPEG)
+    """
+    decode_start = first_frame
+    if pre_roll and first_frame > 0:
+        decode_start = first_frame - 1
+    # Seek half a frame early so rounding never skips decode_start
+    seek = float((decode_start - Fraction(1, 2)) / Fraction(frame_rate)) \
+        if decode_start else None
+    frame_count = last_frame - decode_start if last_frame is not None else None
+    return decode_start, video_to_images(video, output_path, fmt, degradation,
+                                         wait=False, seek=seek,
+                                         frame_count=frame_count, crop=crop)
+
+
+def ECR_Range(video, first_frame=0, last_frame=None, tmp_path=getcwd(),
+              fmt='_%05d.jpg', degradation=5, video_info=None,
+              backend='numpy', tile_rows=None, crop=None,
+              static_tolerance=None):
+    """
+    Edge Change Ratio for a range of frames of a given Video, see
+    decode_range
+    :param video: Path to Video
+    :param first_frame: First frame number to score (inclusive)
+    :param last_frame: Last frame number (exclusive), None for end of Video
+    :param video_info: ffprobe_video dict (only its frame_rate is used),
+                       probed if not given
+    :param backend: edge_change_ratio backend, see get_ecr_backend
+    :param tile_rows: Tiled scoring stripe height, see get_ecr_backend
+    :param crop: Decode and analyse only (width, height, x, y)
+    :param static_tolerance: Score 0 without ECR when frame fingerprints
+                             match within this, see is_static
+    :return: generator of (frame number, ecr)
+    """
+    ecr_function = get_ecr_backend(backend, tile_rows)
+    if video_info is None:
+        video_info = ffprobe_video(video)
+
+    tmp_folder = mkdtemp(dir=tmp_path)
+    tmp_filename = splitext(basename(video))[0]
+    output_path = pathjoin(tmp_folder, tmp_filename)
+    decoder = None
+    try:
+        decode_start, decoder = decode_range(
+            video, output_path, video_info['frame_rate'], first_frame,
+            last_frame, fmt=fmt, degradation=degradation, crop=crop)
+        vstream = ImgSeqStream(tmp_folder, tmp_filename, fmt, decoder)
+        previous_fingerprint, fingerprint = None, None
+        for i, current_frame in enumerate(vstream, decode_start):
+            if static_tolerance is not None:
+                fingerprint = frame_fingerprint(current_frame)
+            if i >= first_frame and i > 0:
+                if is_static(previous_fingerprint, fingerprint,
+                             static_tolerance):
+                    yield i, 0
+                else:
+                    yield i, ecr_function(previous_frame, current_frame,
+                                          float_accuracy=2)
+            previous_frame = current_frame
+            previous_fingerprint = fingerprint
+        returncode = decoder.wait()
+        if returncode != 0:
+            raise IOError('FFMPEG exited with %s decoding frames %s-%s of %s'
+                          % (returncode, first_frame, last_frame, video))
+    finally:
+        if decoder is not None:
+            decoder.stop()
+        rmtree(tmp_folder, True)
+
+
+PROFILES_FILE = pathjoin(getcwd(), 'ecr_profiles.json')
+PROFILE_ECR_PARAMS = ('sigma', 'distance', 'edge_width')
+
+
+def load_profiles(profiles_file=PROFILES_FILE):
+    if not isfile(profiles_file):
+        return dict()
+    with open(profiles_file) as fp:
+        return json.load(fp)
+
+
+def load_profile(name, profiles_file=PROFILES_FILE):
+    """
+    Load a named detection profile, as written by ecr_tuner
+    :param name: Profile name
+    :return: dict of degradation, global_threshold and ECR parameters
+    """
+    profiles = load_profiles(profiles_file)
+    if name not in profiles:
+        raise KeyError('No profile %s in %s' % (name, profiles_file))
+    return profiles[name]
+
+
+def save_profile(name, profile, profiles_file=PROFILES_FILE):
+    profiles = load_profiles(profiles_file)
+    profiles[name] = profile
+    with open(profiles_file, 'w') as fp:
+        json.dump(profiles, fp, indent=2, sort_keys=True)
+
+
+def save_checkpoint(checkpoint, state, previous_frame):
+    """
+    Save the state of a running detection, the previous frame goes to its own
+    .npy written before the json which is the commit point of the checkpoint
+    :param checkpoint: Path to the checkpoint json
+    :param state: dict with at least the processed frame number 'frame'
+    :param previous_frame: ndarray carried over to the next comparison
+    :return: None
+    """
+    old_frame_file = None
+    if isfile(checkpoint):
+        with open(checkpoint) as fp:
+            old_frame_file = json.load(fp).get('frame_file')
+    state['frame_file'] = '%s.%d.npy' % (checkpoint, state['frame'])
+    np.save(state['frame_file'], previous_frame)
+    with open(checkpoint + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    if isfile(checkpoint):
+        remove(checkpoint)  # rename can't overwrite on Windows
+    rename(checkpoint + '.tmp', checkpoint)
+    if old_frame_file and old_frame_file != state['frame_file'] and \
+            isfile(old_frame_file):
+        remove(old_frame_file)
+
+
+def load_checkpoint(checkpoint):
+    """
+    Load a checkpoint written by save_checkpoint
+    :param checkpoint: Path to the checkpoint json
+    :return: tuple (state dict, previous frame ndarray) or (None, None)
+    """
+    if not isfile(checkpoint):
+        return None, None
+    with open(checkpoint) as fp:
+        state = json.load(fp)
+    return state, np.load(state['frame_file'])
+
+
+def remove_checkpoint(checkpoint):
+    state, _ = load_checkpoint(checkpoint)
+    if state is not None:
+        if isfile(state['frame_file']):
+            remove(state['frame_file'])
+        if state.get('frames_dir'):
+            rmtree(state['frames_dir'], True)  # Left by a killed run
+        remove(checkpoint)
 
 
 def SCD_Using_ECR(video, tmp_path=getcwd(), fmt='_%05d.jpg',
-                  global_threshold=80, degradation=5):
+                  global_threshold=80, degradation=5, checkpoint_frames=None,
+                  checkpoint_seconds=None, resume=True, backend='numpy',
+                  tile_rows=None, sample_fraction=None, confidence=0.99,
+                  thumbnails=None, thumbnail_dir=None, contact_sheet=False,
+                  profile=None, profiles_file=PROFILES_FILE, autocrop=False,
+                  crop_recheck_seconds=300, in_point=None, out_point=None,
+                  static_tolerance=None):
     """
     Scene Cut Detection using Edge Change Ratio of a given Video
     :param video: Path to Video
-    :return: None
+    :param checkpoint_frames: Checkpoint every N processed frames
+    :param checkpoint_seconds: Checkpoint every N seconds of processing
+    :param resume: Continue from an existing checkpoint of the same Video
+    :param backend: edge_change_ratio backend, see get_ecr_backend
+    :param tile_rows: Tiled scoring stripe height, see get_ecr_backend
+    :param sample_fraction: Score a sample of stripes, see SampledECR
+    :param confidence: Confidence level of the sampled ECR upper bound
+    :param thumbnails: Save the 'first', 'middle' or 'sharpest' frame of
+                       every shot, see ShotThumbnailer
+    :param thumbnail_dir: Folder of the thumbnails, defaults to getcwd()
+    :param contact_sheet: Also write a contact sheet of the thumbnails
+    :param profile: Name of a tuned profile, its degradation,
+                    global_threshold and ECR parameters override the arguments
+    :param profiles_file: Profiles json, see load_profile
+    :param autocrop: Decode and analyse only the active picture area,
+                     without letterbox/pillarbox bars
+    :param crop_recheck_seconds: Re-run the bar detection this often along
+                                 the Video, see detect_active_area
+    :param in_point: Analyse from this frame number or timecode
+                     ('HH:MM:SS:FF' or 'HH:MM:SS.mm'), frame numbers and
+                     timecodes reported stay relative to the source
+    :param out_point: Analyse up to this frame number or timecode (exclusive)
+    :param static_tolerance: Skip ECR and score 0 when consecutive frame
+                             fingerprints match within this, see is_static
+    :return: dict run summary
     """
-    tmp_folder = mkdtemp(dir=tmp_path)  # Create a temp dir
+    ecr_params = dict()
+    if profile:
+        settings = load_profile(profile, profiles_file)
+        degradation = settings.get('degradation', degradation)
+        global_threshold = settings.get('global_threshold', global_threshold)
+        ecr_params = dict((key, settings[key]) for key in PROFILE_ECR_PARAMS
+                          if key in settings)
+    ecr_function = get_ecr_backend(backend, tile_rows)
+    if sample_fraction:
+        # Seeded, a run and its resumed or repeated runs log the same
+        ecr_function = SampledECR(global_threshold, sample_fraction,
+                                  confidence, full_ecr=ecr_function, seed=0,
+                                  **ecr_params)
+    elif ecr_params:
+        ecr_function = partial(ecr_function, **ecr_params)
     tmp_filename = splitext(basename(video))[0]  # Get name from video
-    output_path = pathjoin(tmp_folder, tmp_filename)  # Join
-    video_to_images(video, output_path, fmt, degradation,
-                    wait=False)  # Convert Video to Images
+    log_filename = pathjoin(getcwd(), '%s.txt' % tmp_filename)
+    checkpoint = pathjoin(getcwd(), '%s.ckpt' % tmp_filename)
 
     video_info = ffprobe_video(video)
     print video_info
-    # Default 00:00:00:00 Source In Timecode
-    begin_timecode = PyTimeCode(video_info['fps'], '00:00:00:00')
-    # Source's Running Timecode
-    video_timecode = PyTimeCode(video_info['fps'], '00:00:00:00')
+    # SMPTE timecodes count whole frames, e.g 24 a second for 23.976
+    timecode_rate = nominal_rate(video_info['fps'])
+    in_frame, out_frame = 0, video_info['frames']
+    if in_point is not None:
+        in_frame = timecode_to_frames(in_point, video_info['frame_rate'])
+    if out_point is not None:
+        out_frame = timecode_to_frames(out_point, video_info['frame_rate'])
+    if not 0 <= in_frame < out_frame <= video_info['frames']:
+        raise ValueError('In/out points %s-%s outside the %s frames of %s' %
+                         (in_frame, out_frame, video_info['frames'], video))
+    # Source In Timecode, 00:00:00:00 unless in_point is given
+    begin_timecode = PyTimeCode(timecode_rate, frames=in_frame)
     # Source's Start Timecode else Defaults to 00:00:00:00
-    start_timecode = PyTimeCode(video_info['fps'], video_info['start_timecode'])
-    # Source's Duration in Timecode
-    end_timecode = PyTimeCode(video_info['fps'],
-                              '00:00:00:00') + video_info['frames']
+    start_timecode = PyTimeCode(timecode_rate, video_info['start_timecode'])
+    # Source's Duration (or out_point) in Timecode
+    end_timecode = PyTimeCode(timecode_rate, '00:00:00:00') + out_frame
     edit_list = list()
+    cut_ecrs = list()
+    first_frame = in_frame
+    log_offset = 0
 
-    with open(pathjoin(getcwd(), '%s.txt' % tmp_filename), 'w+') as fp:
-        vstream = ImgSeqStream(tmp_folder, tmp_filename, fmt)
-        for i, current_frame in enumerate(vstream):
-            if i > 0:
-                ecr = edge_change_ratio(previous_frame, current_frame,
-                                        float_accuracy=2)
-                print video_timecode, i, ecr
-                if ecr > global_threshold:
-                    fp.writelines('{2},{0},{1},CUT!\n'.format(i, ecr,
-                                                              video_timecode))
-                    edit_list.append(video_timecode)
-                else:
-                    fp.writelines('{2},{0},{1}\n'.format(i, ecr,
-                                                         video_timecode))
-            previous_frame = current_frame
-            video_timecode += 1
+    # Settings a checkpoint must have been written with to be resumed
+    identity = {'video': video, 'degradation': degradation,
+                'autocrop': bool(autocrop), 'in_frame': in_frame,
+                'out_frame': out_frame, 'global_threshold': global_threshold,
+                'ecr_params': ecr_params, 'sample_fraction': sample_fraction,
+                'static_tolerance': static_tolerance}
+    state, previous_frame = None, None
+    if resume:
+        state, previous_frame = load_checkpoint(checkpoint)
+    if state is not None and isfile(log_filename) and \
+            all(state.get(key) == value for key, value in identity.items()):
+        first_frame = state['frame'] + 1  # Continue after the saved frame
+        log_offset = state['log_offset']
+        edit_list = [PyTimeCode(timecode_rate, frames=f)
+                     for f in state['edit_list']]
+        cut_ecrs = state['cut_ecrs']
+        rmtree(state['frames_dir'], True)  # Left by a killed run
+        print 'Resuming from frame', first_frame
+    else:
+        remove_checkpoint(checkpoint)
+        previous_frame = None
+
+    crop = None
+    if autocrop:
+        if previous_frame is not None:
+            crop = state['crop']  # Same area as the run being resumed
+        else:
+            crop = detect_active_area(video, video_info, crop_recheck_seconds,
+                                      first_frame=in_frame,
+                                      last_frame=out_frame)
+        print 'Active picture area', crop
+
+    # One folder per run, kept in the checkpoint so a killed run's is removed
+    frames_dir = mkdtemp(prefix=tmp_filename + '.', suffix='.frames',
+                         dir=tmp_path)
+    output_path = pathjoin(frames_dir, tmp_filename)  # Join
+
+    # Source's Running Timecode
+    video_timecode = PyTimeCode(timecode_rate, frames=first_frame)
+    last_frames, last_time = first_frame, time()
+    summary = {'frames': 0, 'crop': crop}
+    if static_tolerance is not None:
+        summary['static_skips'] = 0
+    if previous_frame is not None:
+        # Counters of the run being resumed
+        summary.update(state['counters'])
+        if hasattr(ecr_function, 'restore'):
+            ecr_function.restore(state['sampler'])
+    previous_fingerprint, fingerprint = None, None
+    if previous_frame is not None and static_tolerance is not None:
+        previous_fingerprint = frame_fingerprint(previous_frame)
+    thumbnailer = None
+    if thumbnails:
+        # Decoded images stay on disk until the thumbnailer is closed
+        thumbnailer = ShotThumbnailer(
+            tmp_filename, thumbnail_dir or getcwd(), thumbnails, contact_sheet,
+            state=state.get('thumbnails') if previous_frame is not None
+            else None,
+            load_frame=lambda frame: read_image(pathjoin(
+                frames_dir, tmp_filename + fmt % (frame - decode_start + 1))))
+
+    # Convert Video to Images, with a pre-roll frame unless resumed with it
+    decode_start, decoder = decode_range(
+        video, output_path, video_info['frame_rate'], first_frame,
+        out_frame if out_point is not None else None,
+        pre_roll=previous_frame is None, fmt=fmt, degradation=degradation,
+        crop=crop)
+    try:
+        with open(log_filename, 'r+' if log_offset else 'w+') as fp:
+            fp.truncate(log_offset)  # Drop lines written after the checkpoint
+            fp.seek(log_offset)
 
-    rmtree(tmp_folder, True)
+            def checkpoint_at(frame):
+                fp.flush()
+                counters = dict((key, summary[key]) for key in
+                                ('frames', 'static_skips') if key in summary)
+                if hasattr(ecr_function, 'report'):
+                    counters.update(ecr_function.report())
+                save_checkpoint(checkpoint, dict(
+                    identity, crop=crop, frame=frame, log_offset=fp.tell(),
+                    edit_list=[tc.frames for tc in edit_list],
+                    cut_ecrs=cut_ecrs, counters=counters,
+                    frames_dir=frames_dir, thumbnails=thumbnailer.checkpoint()
+                    if thumbnailer is not None else None,
+                    sampler=ecr_function.checkpoint()
+                    if hasattr(ecr_function, 'checkpoint') else None),
+                    previous_frame)
+
+            vstream = ImgSeqStream(frames_dir, tmp_filename, fmt, decoder)
+            for i, current_frame in enumerate(vstream, decode_start):
+                if static_tolerance is not None:
+                    fingerprint = frame_fingerprint(current_frame)
+                if i < first_frame:
+                    previous_frame = current_frame  # Pre-roll
+                    previous_fingerprint = fingerprint
+                    continue
+                summary['frames'] += 1
+                cut = False
+                if i > 0:
+                    if is_static(previous_fingerprint, fingerprint,
+                                 static_tolerance):
+                        ecr = 0  # Hold, no edge can have changed
+                        summary['static_skips'] += 1
+                    else:
+                        ecr = ecr_function(previous_frame, current_frame,
+                                           float_accuracy=2)
+                    print video_timecode, i, ecr
+                    if ecr > global_threshold:
+                        cut = True
+                        fp.writelines(log_line(video_timecode, i, ecr, True))
+                        edit_list.append(video_timecode)
+                        cut_ecrs.append(ecr)
+                    else:
+                        fp.writelines(log_line(video_timecode, i, ecr))
+                if thumbnailer is not None:
+                    thumbnailer.add(i, current_frame, cut)
+                previous_frame = current_frame
+                previous_fingerprint = fingerprint
+                video_timecode += 1
+
+                if (checkpoint_frames and
+                        i + 1 - last_frames >= checkpoint_frames or
+                        checkpoint_seconds and
+                        time() - last_time >= checkpoint_seconds):
+                    checkpoint_at(i)
+                    last_frames, last_time = i + 1, time()
+
+            returncode = decoder.wait()
+            if returncode != 0 and summary['frames']:
+                checkpoint_at(i)  # Keep what was scored for the next run
+        if returncode != 0:
+            raise IOError('FFMPEG exited with %s before frame %s of %s, run '
+                          'again to resume' % (returncode, video_timecode,
+                                               video))
+        if thumbnailer is not None:
+            summary['thumbnails'] = thumbnailer.close()
+    finally:
+        decoder.stop()
+        rmtree(frames_dir, True)
+    # Only a run that reached out_frame or the end of the Video gets here
+    remove_checkpoint(checkpoint)
     print edit_list
     createEDL(begin_timecode, start_timecode, end_timecode, edit_list,
               tmp_filename, '%s.edl' % tmp_filename)
+    write_index(index_path(video, getcwd()), video_info['fps'], out_frame,
+                video_info['start_timecode'],
+                zip([tc.frames for tc in edit_list], cut_ecrs), in_frame)
+    summary['cuts'] = len(edit_list)
+    if static_tolerance is not None:
+        summary['static_skip_rate'] = round(
+            float(summary['static_skips']) / max(summary['frames'], 1), 4)
+    if hasattr(ecr_function, 'report'):
+        summary.update(ecr_function.report())
+    print summary
+    return summary
 
 
 def createEDL(begin_timecode, start_timecode, end_timecode, edit_list,
@@ -180,7 +994,19 @@ def createEDL(begin_timecode, start_timecode, end_timecode, edit_list,
         fp.write('TITLE:  {0}\n'.format(video_filename))
         fp.write('FCM: NON-DROP FRAME\n\n')
 
-        fp.write(_fmt.format(1, begin_timecode, edit_list[0]-1, start_timecode,
+        if edit_list and edit_list[0].frames == begin_timecode.frames:
+            # CUT! on the in point, no event before it
+            begin_timecode, edit_list = edit_list[0], edit_list[1:]
+
+        if not edit_list:  # No cut, a single event
+            fp.write(_fmt.format(1, begin_timecode, end_timecode,
+                                 start_timecode+begin_timecode,
+                                 start_timecode+end_timecode))
+            fp.write(_cmt)
+            return
+
+        fp.write(_fmt.format(1, begin_timecode, edit_list[0]-1,
+                             start_timecode+begin_timecode,
                              start_timecode+edit_list[0]-1))
         fp.write(_cmt)
         # print _fmt.format(1, begin_timecode, edit_list[0], start_timecode,
@@ -203,4 +1029,13 @@ def createEDL(begin_timecode, start_timecode, end_timecode, edit_list,
                 fp.write(_cmt)
                 # print _fmt.format(i, cut, end_timecode, start_timecode+cut,
                 #                   start_timecode+end_timecode)
-                # print _cmt
\ No newline at end of file
+                # print _cmt
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        # scene_cut_detect.py <image folder> <image name prefix> [fmt]
+        print benchmark_sampled(list(ImgSeqStream(*sys.argv[1:4])))
+    else:
+        print benchmark_sampled(pan_frames())
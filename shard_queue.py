@@ -0,0 +1,555 @@
+"""
+Sharded Scene Cut Detection across several worker processes or nodes.
+
+A coordinator splits every video into time range shards and publishes them
+to a SQLite work queue on a shared path. Workers claim shards under a lease,
+run the Edge Change Ratio detector over their range and write a partial log.
+Shards whose lease runs out (dead worker) or whose run fails are handed out
+again, up to max_attempts times before they are marked failed. Once every
+shard of a video is done the partial logs are merged into the final log and
+EDL, the same outputs SCD_Using_ECR writes.
+
+`shard_queue.py check` runs self_check, the lease, retry and merge logic on
+a scratch queue, no video or FFMPEG needed.
+"""
+from os import getcwd, getpid, remove, mkdir, rmdir
+from os.path import basename, dirname, join as pathjoin, splitext, isfile
+from socket import gethostname
+from time import time, sleep
+from threading import Thread, Event
+from glob import glob
+from fractions import Fraction
+from tempfile import mkdtemp
+from shutil import rmtree
+import sqlite3
+import argparse
+from ffmpeg_utils import ffprobe_video
+from pytimecode import PyTimeCode
+from timecode_utils import nominal_rate
+from scene_cut_detect import ECR_Range, createEDL, log_line, parse_log_line
+from shot_index import write_index, index_path
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS videos (
+    video TEXT PRIMARY KEY,
+    fps REAL,
+    frame_rate TEXT,
+    frames INTEGER,
+    start_timecode TEXT,
+    merged INTEGER DEFAULT 0,
+    merge_expires REAL
+);
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    video TEXT,
+    shard INTEGER,
+    first_frame INTEGER,
+    last_frame INTEGER,
+    state TEXT DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    UNIQUE (video, shard)
+);
+"""
+
+
+class ShardLeaseLost(Exception):
+    pass
+
+
+class ShardQueue(object):
+    """SQLite backed queue of video shards with lease timeouts"""
+    def __init__(self, db_path, lease_timeout=600, max_attempts=3):
+        self.db_path = db_path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        # Autocommit, transactions are opened explicitly where needed
+        self.db = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def publish(self, video, shard_seconds=300, video_info=None):
+        """
+        Split a Video into shards of shard_seconds and queue them
+        :param video: Path to Video, must be reachable from every node
+        :param shard_seconds: Length of a shard in seconds
+        :return: Number of shards
+        """
+        if video_info is None:
+            video_info = ffprobe_video(video)
+        frames = video_info['frames']
+        shard_frames = max(int(shard_seconds * video_info['frame_rate']), 1)
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            # The exact rate ('24000/1001') seeks shards, fps is for timecodes
+            self.db.execute('INSERT OR REPLACE INTO videos (video, fps, '
+                            'frame_rate, frames, start_timecode) '
+                            'VALUES (?,?,?,?,?)',
+                            (video, video_info['fps'],
+                             str(video_info['frame_rate']), frames,
+                             video_info['start_timecode']))
+            self.db.execute('DELETE FROM shards WHERE video=?', (video,))
+            starts = range(0, frames, shard_frames)
+            for shard, first in enumerate(starts):
+                self.db.execute(
+                    'INSERT INTO shards (video, shard, first_frame, '
+                    'last_frame) VALUES (?,?,?,?)',
+                    (video, shard, first, min(first + shard_frames, frames)))
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        return len(starts)
+
+    def claim(self, worker):
+        """
+        Claim a pending shard, or one whose lease has expired
+        :param worker: Worker id
+        :return: sqlite3.Row of the shard or None if nothing is left
+        """
+        now = time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            # Shards that keep killing their workers are not handed out again
+            self.db.execute(
+                'UPDATE shards SET state=?, error=? WHERE state=? AND '
+                'lease_expires<? AND attempts>=?',
+                (FAILED, 'Lease expired', RUNNING, now, self.max_attempts))
+            row = self.db.execute(
+                'SELECT * FROM shards WHERE state=? OR '
+                '(state=? AND lease_expires<?) ORDER BY video, shard LIMIT 1',
+                (PENDING, RUNNING, now)).fetchone()
+            if row is not None:
+                self.db.execute(
+                    'UPDATE shards SET state=?, worker=?, lease_expires=?, '
+                    'attempts=attempts+1 WHERE id=?',
+                    (RUNNING, worker, now + self.lease_timeout, row['id']))
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        return row
+
+    def renew(self, shard_id, worker):
+        """Extend the lease of a claimed shard, raise if it was reclaimed"""
+        cur = self.db.execute(
+            'UPDATE shards SET lease_expires=? '
+            'WHERE id=? AND worker=? AND state=?',
+            (time() + self.lease_timeout, shard_id, worker, RUNNING))
+        if cur.rowcount != 1:
+            raise ShardLeaseLost('Shard %s no longer leased to %s'
+                                 % (shard_id, worker))
+
+    def complete(self, shard_id, worker, result):
+        """Mark a claimed shard as done with the path to its partial log"""
+        cur = self.db.execute(
+            'UPDATE shards SET state=?, result=? '
+            'WHERE id=? AND worker=? AND state=?',
+            (DONE, result, shard_id, worker, RUNNING))
+        if cur.rowcount != 1:
+            raise ShardLeaseLost('Shard %s no longer leased to %s'
+                                 % (shard_id, worker))
+
+    def fail(self, shard_id, worker, error):
+        """
+        Give back a claimed shard whose run raised, it is failed for good
+        once it has been attempted max_attempts times
+        :param error: Error message kept with the shard
+        :return: True if the shard is failed for good
+        """
+        cur = self.db.execute(
+            'UPDATE shards SET state=CASE WHEN attempts>=? THEN ? ELSE ? END, '
+            'error=?, lease_expires=NULL WHERE id=? AND worker=? AND state=?',
+            (self.max_attempts, FAILED, PENDING, error, shard_id, worker,
+             RUNNING))
+        if cur.rowcount != 1:
+            raise ShardLeaseLost('Shard %s no longer leased to %s'
+                                 % (shard_id, worker))
+        return self.db.execute('SELECT state FROM shards WHERE id=?',
+                               (shard_id,)).fetchone()[0] == FAILED
+
+    def failed(self):
+        return self.db.execute('SELECT * FROM shards WHERE state=? '
+                               'ORDER BY video, shard', (FAILED,)).fetchall()
+
+    def video(self, video):
+        return self.db.execute('SELECT * FROM videos WHERE video=?',
+                               (video,)).fetchone()
+
+    def shards(self, video):
+        return self.db.execute('SELECT * FROM shards WHERE video=? '
+                               'ORDER BY shard', (video,)).fetchall()
+
+    def is_done(self, video):
+        return self.db.execute(
+            'SELECT COUNT(*) FROM shards WHERE video=? AND state!=?',
+            (video, DONE)).fetchone()[0] == 0
+
+    def claim_merge(self, video):
+        """
+        Atomically take the merge of a finished Video under a lease, True if
+        ours. A merge is only marked done by complete_merge, so a merge that
+        raised or whose worker died is taken again once its lease expires.
+        """
+        if not self.is_done(video):
+            return False
+        now = time()
+        cur = self.db.execute(
+            'UPDATE videos SET merge_expires=? WHERE video=? AND merged=0 AND '
+            '(merge_expires IS NULL OR merge_expires<?)',
+            (now + self.lease_timeout, video, now))
+        return cur.rowcount == 1
+
+    def complete_merge(self, video):
+        self.db.execute('UPDATE videos SET merged=1 WHERE video=?', (video,))
+
+    def release_merge(self, video):
+        """Give back the merge of a Video so it can be retried at once"""
+        self.db.execute('UPDATE videos SET merge_expires=NULL '
+                        'WHERE video=? AND merged=0', (video,))
+
+    def unmerged(self):
+        return [row['video'] for row in self.db.execute(
+            'SELECT video FROM videos WHERE merged=0').fetchall()]
+
+
+def worker_id():
+    return '%s:%s' % (gethostname(), getpid())
+
+
+class LeaseHeartbeat(Thread):
+    """
+    Renew the lease of a running shard every lease_timeout / 3 from its own
+    connection, so the lease holds while the shard decodes or scores
+    """
+    def __init__(self, queue, shard_id, worker):
+        Thread.__init__(self)
+        self.daemon = True
+        self.db_path = queue.db_path
+        self.lease_timeout = queue.lease_timeout
+        self.shard_id = shard_id
+        self.worker = worker
+        self.stopped = Event()
+        self.lost = None  # ShardLeaseLost once the shard was reclaimed
+
+    def run(self):
+        queue = ShardQueue(self.db_path, self.lease_timeout)
+        try:
+            while not self.stopped.wait(self.lease_timeout / 3.0):
+                try:
+                    queue.renew(self.shard_id, self.worker)
+                except ShardLeaseLost as e:
+                    self.lost = e
+                    break
+                except sqlite3.Error as e:
+                    print e  # Busy database, try again next beat
+        finally:
+            queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def part_path(output_dir, shard):
+    """Partial log of a shard attempt"""
+    name = splitext(basename(shard['video']))[0]
+    # Unique per attempt so a stale worker never overwrites a reclaimed shard
+    return pathjoin(output_dir, '%s.%05d.%s.part' % (name, shard['shard'],
+                                                     shard['attempts'] + 1))
+
+
+def run_shard(queue, shard, worker, output_dir=getcwd(), tmp_path=getcwd(),
+              degradation=5, global_threshold=80):
+    """
+    Run the detector over one claimed shard and write its partial log
+    :return: Path to the partial log
+    """
+    info = queue.video(shard['video'])
+    video_info = {'fps': info['fps'], 'frames': info['frames'],
+                  'frame_rate': Fraction(info['frame_rate'])}
+    result = part_path(output_dir, shard)
+    heartbeat = LeaseHeartbeat(queue, shard['id'], worker)
+    heartbeat.start()
+    try:
+        with open(result, 'w+') as fp:
+            for i, ecr in ECR_Range(shard['video'], shard['first_frame'],
+                                    shard['last_frame'], tmp_path,
+                                    degradation=degradation,
+                                    video_info=video_info):
+                if heartbeat.lost:
+                    raise heartbeat.lost
+                timecode = PyTimeCode(nominal_rate(info['fps']), frames=i)
+                fp.writelines(log_line(timecode, i, ecr,
+                                       ecr > global_threshold))
+    finally:
+        heartbeat.stop()
+    if heartbeat.lost:
+        raise heartbeat.lost
+    return result
+
+
+def merge_video(queue, video, output_dir=getcwd()):
+    """
+    Assemble the partial logs of a Video into its final log and EDL
+    :param queue: ShardQueue
+    :param video: Path to Video as published
+    :return: List of cut timecodes
+    """
+    info = queue.video(video)
+    name = splitext(basename(video))[0]
+    fps = nominal_rate(info['fps'])
+    edit_list = list()
+    cut_ecrs = list()
+    with open(pathjoin(output_dir, '%s.txt' % name), 'w+') as fp:
+        for shard in queue.shards(video):
+            with open(shard['result']) as part:
+                for line in part:
+                    fp.writelines(line)
+                    timecode, i, ecr, cut = parse_log_line(line)
+                    if cut:
+                        edit_list.append(PyTimeCode(fps, frames=i))
+                        cut_ecrs.append(ecr)
+
+    begin_timecode = PyTimeCode(fps, '00:00:00:00')
+    start_timecode = PyTimeCode(fps, info['start_timecode'])
+    end_timecode = PyTimeCode(fps, '00:00:00:00') + info['frames']
+    createEDL(begin_timecode, start_timecode, end_timecode, edit_list,
+              name, pathjoin(output_dir, '%s.edl' % name))
+    write_index(index_path(video, output_dir), info['fps'], info['frames'],
+                info['start_timecode'],
+                zip([tc.frames for tc in edit_list], cut_ecrs))
+    return edit_list
+
+
+def remove_parts(queue, video):
+    """Remove the partial logs of every shard of a merged Video"""
+    name = splitext(basename(video))[0]
+    for shard in queue.shards(video):
+        # Every attempt, including those of workers that died or lost a lease
+        for part in glob(pathjoin(dirname(shard['result']), '%s.%05d.*.part'
+                                  % (name, shard['shard']))):
+            remove(part)
+
+
+def try_merge(queue, video, output_dir=getcwd()):
+    """
+    Merge a Video if all its shards are done and no one else is merging it,
+    the merge is only marked done once merge_video succeeded and the partial
+    logs are kept until then for a retry
+    :return: List of cut timecodes or None if the merge was not ours
+    """
+    if not queue.claim_merge(video):
+        return None
+    try:
+        edit_list = merge_video(queue, video, output_dir)
+    except:
+        queue.release_merge(video)
+        raise
+    queue.complete_merge(video)
+    remove_parts(queue, video)
+    return edit_list
+
+
+def run_worker(db_path, output_dir=getcwd(), tmp_path=getcwd(),
+               degradation=5, global_threshold=80, lease_timeout=600,
+               poll=5, exit_when_empty=True, max_attempts=3):
+    """
+    Claim and process shards until the queue is empty, a shard that raises
+    is given back and the worker carries on with the next one
+    :param db_path: Path to the shared SQLite queue
+    :param output_dir: Shared directory for partial and final results
+    :param poll: Seconds to wait before polling an empty queue again
+    :param exit_when_empty: Return once no shard can be claimed
+    :param max_attempts: Attempts of a shard before it is marked failed
+    :return: Number of shards processed
+    """
+    queue = ShardQueue(db_path, lease_timeout, max_attempts)
+    worker = worker_id()
+    processed = 0
+    try:
+        while True:
+            shard = queue.claim(worker)
+            if shard is None:
+                if exit_when_empty:
+                    break
+                sleep(poll)
+                continue
+            try:
+                result = run_shard(queue, shard, worker, output_dir, tmp_path,
+                                   degradation, global_threshold)
+                queue.complete(shard['id'], worker, result)
+            except ShardLeaseLost as e:
+                print e  # Someone else owns the shard now
+                discard(part_path(output_dir, shard))
+                continue
+            except Exception as e:
+                print 'Shard', shard['id'], 'of', shard['video'], 'failed:', e
+                discard(part_path(output_dir, shard))
+                try:
+                    if queue.fail(shard['id'], worker, repr(e)):
+                        print 'Giving up on shard', shard['id'], 'after', \
+                            shard['attempts'] + 1, 'attempts'
+                except ShardLeaseLost as e:
+                    print e
+                continue
+            processed += 1
+            try:
+                try_merge(queue, shard['video'], output_dir)
+            except Exception as e:
+                print 'Merge of', shard['video'], 'failed:', e
+    finally:
+        queue.close()
+    return processed
+
+
+def discard(path):
+    if isfile(path):
+        remove(path)
+
+
+def self_check(lease_timeout=0.2):
+    """
+    Check the queue logic on a scratch queue in a temporary folder: an
+    expired lease is claimed again, a shard is failed after max_attempts
+    and a merge that raised is retried from the partial logs
+    :return: list of (check, passed)
+    """
+    checks = list()
+
+    def check(name, passed):
+        checks.append((name, bool(passed)))
+
+    folder = mkdtemp()
+    queue = ShardQueue(pathjoin(folder, 'queue.db'), lease_timeout,
+                       max_attempts=2)
+    video_info = {'fps': 25.0, 'frame_rate': Fraction(25), 'frames': 100,
+                  'start_timecode': '00:00:00:00'}
+    try:
+        check('publish', queue.publish('a.mov', 2, video_info) == 2)
+
+        shard = queue.claim('A')
+        sleep(lease_timeout * 1.5)  # Worker A died
+        reclaimed = queue.claim('B')
+        check('expired lease is claimed again',
+              reclaimed['id'] == shard['id'] and
+              reclaimed['attempts'] == shard['attempts'] + 1)
+        try:
+            queue.complete(shard['id'], 'A', 'stale')
+            check('stale worker loses the shard', False)
+        except ShardLeaseLost:
+            check('stale worker loses the shard', True)
+        check('failed after max_attempts',
+              queue.fail(reclaimed['id'], 'B', 'IOError()') and
+              [row['id'] for row in queue.failed()] == [shard['id']])
+
+        shard = queue.claim('A')
+        check('failed shard is given back',
+              not queue.fail(shard['id'], 'A', 'IOError()') and
+              queue.claim('B')['id'] == shard['id'])
+        sleep(lease_timeout * 1.5)
+        check('expired lease at max_attempts is failed',
+              queue.claim('A') is None and len(queue.failed()) == 2)
+
+        check('publish again', queue.publish('b.mov', 2, video_info) == 2)
+        for shard in iter(lambda: queue.claim('A'), None):
+            result = part_path(folder, shard)
+            with open(result, 'w') as fp:
+                for i in xrange(shard['first_frame'] or 1,
+                                shard['last_frame']):
+                    fp.writelines(log_line(PyTimeCode(25, frames=i), i,
+                                           100 if i == 60 else 10, i == 60))
+            queue.complete(shard['id'], 'A', result)
+        mkdir(index_path('b.mov', folder))  # write_index raises
+        try:
+            try_merge(queue, 'b.mov', folder)
+            check('merge raises', False)
+        except EnvironmentError:
+            check('merge raises', True)
+        check('merge is released with its partial logs',
+              'b.mov' in queue.unmerged() and
+              len(glob(pathjoin(folder, '*.part'))) == 2)
+        rmdir(index_path('b.mov', folder))
+        try:
+            edit_list = try_merge(queue, 'b.mov', folder)
+        except EnvironmentError:
+            edit_list = None
+        check('merge is retried',
+              edit_list is not None and
+              [tc.frames for tc in edit_list] == [60] and
+              'b.mov' not in queue.unmerged() and
+              isfile(index_path('b.mov', folder)) and
+              not glob(pathjoin(folder, '*.part')))
+    finally:
+        queue.close()
+        rmtree(folder, True)
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('db', help='Path to the shared SQLite queue')
+    sub = parser.add_subparsers(dest='command')
+    publish = sub.add_parser('publish', help='Shard and queue videos')
+    publish.add_argument('videos', nargs='+')
+    publish.add_argument('--shard-seconds', type=float, default=300)
+    worker = sub.add_parser('worker', help='Process queued shards')
+    worker.add_argument('--output-dir', default=getcwd())
+    worker.add_argument('--tmp-path', default=getcwd())
+    worker.add_argument('--degradation', type=int, default=5)
+    worker.add_argument('--threshold', type=float, default=80)
+    worker.add_argument('--lease-timeout', type=float, default=600)
+    worker.add_argument('--max-attempts', type=int, default=3)
+    worker.add_argument('--forever', action='store_true',
+                        help='Keep polling when the queue is empty')
+    merge = sub.add_parser('merge', help='Merge finished videos')
+    merge.add_argument('--output-dir', default=getcwd())
+    args = parser.parse_args()
+
+    if args.command == 'publish':
+        queue = ShardQueue(args.db)
+        for video in args.videos:
+            print video, queue.publish(video, args.shard_seconds), 'shards'
+        queue.close()
+    elif args.command == 'worker':
+        print run_worker(args.db, args.output_dir, args.tmp_path,
+                         args.degradation, args.threshold,
+                         args.lease_timeout,
+                         exit_when_empty=not args.forever,
+                         max_attempts=args.max_attempts), 'shards processed'
+    elif args.command == 'merge':
+        queue = ShardQueue(args.db)
+        for video in queue.unmerged():
+            try:
+                edit_list = try_merge(queue, video, args.output_dir)
+            except Exception as e:
+                print video, 'merge failed:', e
+                continue
+            if edit_list is not None:
+                print video, edit_list
+        for shard in queue.failed():
+            print 'Failed', shard['video'], 'shard', shard['shard'], \
+                shard['error']
+        queue.close()
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['check']:
+        # shard_queue.py check
+        checks = self_check()
+        for name, passed in checks:
+            print 'ok  ' if passed else 'FAIL', name
+        sys.exit(0 if all(passed for name, passed in checks) else 1)
+    main()
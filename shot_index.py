@@ -0,0 +1,150 @@
+"""
+Memory-mapped sidecar index of shot boundaries.
+
+The detector writes <video>.shots next to the log and EDL: a small header
+with the analysed frame range and three columns, the first frame of every
+shot, the ECR of the cut that starts it and its source frame (start
+timecode + frame). Columns are memory mapped, lookups by frame or timecode
+are binary searches, so an index is opened and queried in microseconds
+without parsing the .txt or .edl.
+"""
+from os.path import basename, join as pathjoin, splitext
+from glob import glob
+import struct
+import numpy as np
+from pytimecode import PyTimeCode
+from timecode_utils import nominal_rate, timecode_to_frames
+
+MAGIC = 'SCDX'
+VERSION = 1
+# magic, version, fps, first frame, last frame, shots, start timecode
+_header = struct.Struct('<4sHdqqq16s')
+HEADER_SIZE = 64
+
+
+class ShotIndexError(Exception):
+    pass
+
+
+def write_index(path, fps, frames, start_timecode, cuts, first_frame=0):
+    """
+    Write a shot index
+    :param path: Path of the .shots file
+    :param fps: Video frame rate
+    :param frames: Last frame analysed (exclusive), the Video length
+    :param start_timecode: Source start timecode 'HH:MM:SS:FF'
+    :param cuts: list of (frame number, ecr) of every CUT!, in order
+    :param first_frame: First frame analysed
+    :return: Number of shots
+    """
+    start = PyTimeCode(nominal_rate(fps), str(start_timecode)).frames
+    cuts = list(cuts)
+    first_ecr = 0
+    if cuts and int(cuts[0][0]) == first_frame:
+        first_ecr = float(cuts.pop(0)[1])  # CUT! on first_frame starts shot 0
+    first_frames = np.array([first_frame] + [int(f) for f, _ in cuts], '<i8')
+    ecrs = np.array([first_ecr] + [float(e) for _, e in cuts], '<f8')
+    with open(path, 'wb') as fp:
+        fp.write(_header.pack(MAGIC, VERSION, float(fps), int(first_frame),
+                              int(frames), len(first_frames),
+                              str(start_timecode))
+                 .ljust(HEADER_SIZE, '\0'))
+        fp.write(first_frames.tostring())
+        fp.write(ecrs.tostring())
+        fp.write((first_frames + start).tostring())
+    return len(first_frames)
+
+
+def index_path(video, output_dir):
+    return pathjoin(output_dir, '%s.shots' % splitext(basename(video))[0])
+
+
+class ShotIndex(object):
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            magic, version, self.fps, self.first_frame, self.frames, shots, \
+                timecode = _header.unpack(fp.read(_header.size))
+        if magic != MAGIC or version != VERSION:
+            raise ShotIndexError('%s is not a version %s shot index'
+                                 % (path, VERSION))
+        self.path = path
+        self.start_timecode = timecode.rstrip('\0')
+        self.rate = nominal_rate(self.fps)  # Of the timecodes
+        self.start = PyTimeCode(self.rate, self.start_timecode).frames
+        offset = HEADER_SIZE
+        self.first_frames = np.memmap(path, '<i8', 'r', offset, (shots,))
+        offset += shots * 8
+        self.ecrs = np.memmap(path, '<f8', 'r', offset, (shots,))
+        offset += shots * 8
+        self.source_frames = np.memmap(path, '<i8', 'r', offset, (shots,))
+
+    def __len__(self):
+        return len(self.first_frames)
+
+    def to_frame(self, timecode, source=False):
+        """
+        Frame number of a timecode
+        :param timecode: 'HH:MM:SS:FF', 'HH:MM:SS.mm', PyTimeCode or frame
+                         number, see timecode_to_frames
+        :param source: The timecode is a source timecode (from the start
+                       timecode) rather than relative to frame 0
+        """
+        if isinstance(timecode, (int, long, np.integer)):
+            frame = timecode
+        elif isinstance(timecode, PyTimeCode):
+            frame = timecode.frames
+        else:
+            frame = timecode_to_frames(timecode, self.fps)
+        return frame - self.start if source else frame
+
+    def shot_at_frame(self, frame):
+        """Number (0 based) of the shot containing frame"""
+        if not self.first_frame <= frame < self.frames:
+            raise IndexError('Frame %s outside %s-%s'
+                             % (frame, self.first_frame, self.frames))
+        return int(np.searchsorted(self.first_frames, frame, 'right')) - 1
+
+    def shot_at_timecode(self, timecode, source=False):
+        return self.shot_at_frame(self.to_frame(timecode, source))
+
+    def shot(self, n):
+        """
+        A shot by number
+        :return: dict of first and last frame (exclusive), the ECR of the
+                 cut and the source in and out timecodes
+        """
+        first = int(self.first_frames[n])
+        last = int(self.first_frames[n + 1]) if n + 1 < len(self) \
+            else self.frames
+        return {'shot': n, 'first_frame': first, 'last_frame': last,
+                'ecr': float(self.ecrs[n]),
+                'source_in': PyTimeCode(self.rate, frames=self.start + first),
+                'source_out': PyTimeCode(self.rate, frames=self.start + last)}
+
+    def shots_between(self, timecode_in, timecode_out, source=False):
+        """Shots overlapping [timecode_in, timecode_out)"""
+        first = max(self.to_frame(timecode_in, source), self.first_frame)
+        last = min(self.to_frame(timecode_out, source), self.frames)
+        if first >= last:
+            return []
+        return [self.shot(n) for n in xrange(self.shot_at_frame(first),
+                                             self.shot_at_frame(last - 1) + 1)]
+
+
+class ShotLibrary(object):
+    """Shot indexes of a folder, opened on first use"""
+    def __init__(self, directory):
+        self.paths = dict((splitext(basename(path))[0], path)
+                          for path in glob(pathjoin(directory, '*.shots')))
+        self.indexes = dict()
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def __getitem__(self, name):
+        if name not in self.indexes:
+            self.indexes[name] = ShotIndex(self.paths[name])
+        return self.indexes[name]
+
+    def names(self):
+        return sorted(self.paths)
@@ -0,0 +1,182 @@
+"""
+Shot thumbnails from the frames Scene Cut Detection already decoded.
+
+ShotThumbnailer is fed every analysed frame with its CUT! decision and keeps
+the first, middle or sharpest frame of the running shot. When a shot ends its
+frame is handed to a background thread that encodes the thumbnail, so the
+detection loop never waits on image encoding. The middle frame is only known
+once the shot ends, it is loaded back from the decoded images then.
+
+A checkpoint writes the running shot's candidate at once, a resumed run
+restores the shot number and candidate and keeps it unless a better frame
+comes. The middle frame of a shot spanning a resume can only be taken from
+the frames decoded after it, the first of them if the middle came before.
+"""
+from threading import Thread
+from Queue import Queue
+from os.path import join as pathjoin, isfile
+from PIL import Image
+
+FIRST = 'first'
+MIDDLE = 'middle'
+SHARPEST = 'sharpest'
+
+
+def sharpness(frame):
+    """Variance of the laplacian of the greyscale (brightest channel)"""
+    grey = frame.max(2).astype('float32')
+    laplacian = (grey[:-2, 1:-1] + grey[2:, 1:-1] + grey[1:-1, :-2] +
+                 grey[1:-1, 2:] - 4 * grey[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+class ShotThumbnailer(object):
+    def __init__(self, name, output_dir, mode=FIRST, contact_sheet=False,
+                 state=None, quality=90, sheet_columns=6, sheet_width=160,
+                 load_frame=None):
+        """
+        :param name: Video name used to name the images
+        :param output_dir: Folder of the thumbnails and contact sheet
+        :param mode: 'first', 'middle' or 'sharpest' frame of each shot
+        :param contact_sheet: Also write a contact sheet of all shots
+        :param state: checkpoint() of the run being resumed
+        :param load_frame: function of a frame number returning the frame as
+                           decoded by the detector, required by 'middle'
+        """
+        if mode not in (FIRST, MIDDLE, SHARPEST):
+            raise ValueError('Unknown thumbnail mode %s' % mode)
+        if mode == MIDDLE and load_frame is None:
+            raise ValueError('Thumbnail mode middle needs load_frame')
+        self.name = name
+        self.output_dir = output_dir
+        self.mode = mode
+        self.contact_sheet = contact_sheet
+        self.quality = quality
+        self.sheet_columns = sheet_columns
+        self.sheet_width = sheet_width
+        self.shot = 1
+        self.load_frame = load_frame
+        self.shot_frames = 0
+        self.shot_start = None  # Frame number of the first frame of the shot
+        self.candidate = None  # (frame number, frame) kept for the shot
+        self.best = None
+        self.saved = 0
+        self.written = None  # Candidate frame number already on disk
+        self.first_loadable = None  # First frame fed after a resume
+        if state is not None:
+            self.shot, self.shot_frames, self.shot_start, self.saved = \
+                state['shot'], state['shot_frames'], state['shot_start'], \
+                state['saved']
+            if state['candidate'] is not None and state['mode'] == mode:
+                self.candidate = (state['candidate'], None)
+                self.best = state['best']
+                self.written = state['candidate']
+        self.queue = Queue(maxsize=16)  # Bounds frames waiting to encode
+        self.writer = Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def thumbnail_path(self, shot):
+        return pathjoin(self.output_dir,
+                        '%s_shot_%04d.jpg' % (self.name, shot))
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            shot, frame_number, frame = item
+            try:
+                if frame is None:
+                    frame = self.load_frame(frame_number)
+                Image.fromarray(frame).save(self.thumbnail_path(shot),
+                                            quality=self.quality)
+            except Exception as e:
+                print e  # Keep draining so the detector never blocks
+
+    def _end_shot(self):
+        if self.mode == MIDDLE and self.shot_frames:
+            # Loaded by the writer, never held in memory along the shot
+            self.candidate = (max(self.shot_start + self.shot_frames // 2,
+                                  self.first_loadable), None)
+        if self.candidate is not None:
+            if self.candidate[0] != self.written:
+                self.queue.put((self.shot,) + self.candidate)
+            self.saved += 1
+        self.candidate, self.best, self.written = None, None, None
+
+    def add(self, frame_number, frame, cut=False):
+        """
+        Feed the next analysed frame
+        :param frame_number: Frame number in the Video
+        :param frame: ndarray as decoded by the detector
+        :param cut: The frame starts a new shot
+        """
+        if self.first_loadable is None:
+            self.first_loadable = frame_number
+        if cut and self.shot_frames:  # A CUT! on the first frame starts shot 1
+            self._end_shot()
+            self.shot += 1
+            self.shot_frames = 0
+        if not self.shot_frames:
+            self.shot_start = frame_number
+        self.shot_frames += 1
+
+        if self.mode == FIRST:
+            if self.candidate is None:
+                self.candidate = (frame_number, frame)
+        elif self.mode == SHARPEST:
+            score = sharpness(frame)
+            if self.best is None or score > self.best:
+                self.best = score
+                self.candidate = (frame_number, frame)
+
+    def checkpoint(self):
+        """
+        Write the running shot's candidate now, it is lost with the decoded
+        images if the run dies
+        :return: dict state to resume with
+        """
+        if self.candidate is not None and self.candidate[1] is not None and \
+                self.candidate[0] != self.written:
+            Image.fromarray(self.candidate[1]).save(
+                self.thumbnail_path(self.shot), quality=self.quality)
+            self.written = self.candidate[0]
+        return {'mode': self.mode, 'shot': self.shot,
+                'shot_frames': self.shot_frames, 'shot_start': self.shot_start,
+                'candidate': self.written, 'best': self.best,
+                'saved': self.saved}
+
+    def close(self):
+        """
+        Flush the last shot, wait for the encoder and write the contact sheet
+        :return: Number of thumbnails written
+        """
+        if self.shot_frames:
+            self._end_shot()
+        self.queue.put(None)
+        self.writer.join()
+        if self.contact_sheet:
+            self.write_contact_sheet()
+        return self.saved
+
+    def write_contact_sheet(self):
+        """Grid of every shot thumbnail found in output_dir"""
+        thumbnails = list()
+        for shot in xrange(1, self.shot + 1):
+            if isfile(self.thumbnail_path(shot)):
+                img = Image.open(self.thumbnail_path(shot))
+                height = img.size[1] * self.sheet_width // img.size[0]
+                thumbnails.append(img.resize((self.sheet_width, height)))
+        if not thumbnails:
+            return None
+        cell_height = max(img.size[1] for img in thumbnails)
+        rows = (len(thumbnails) + self.sheet_columns - 1) // self.sheet_columns
+        sheet = Image.new('RGB', (self.sheet_width * self.sheet_columns,
+                                  cell_height * rows))
+        for n, img in enumerate(thumbnails):
+            sheet.paste(img, ((n % self.sheet_columns) * self.sheet_width,
+                              (n // self.sheet_columns) * cell_height))
+        path = pathjoin(self.output_dir, '%s_contact.jpg' % self.name)
+        sheet.save(path, quality=self.quality)
+        return path
@@ -1,3 +1,7 @@
+import re
+from pytimecode import PyTimeCode
+
+
 def convert_ms2frames(fps, ms):
     """Converts Milliseconds to frames
     :param: Video Frame Rate e.g '25'
@@ -40,4 +44,32 @@ def timecode_to_seconds(timecode, fps=0):
 
 
 def seconds_to_frames(total_seconds, fps):
-    return int(total_seconds * fps)
\ No newline at end of file
+    return int(total_seconds * fps)
+
+
+def nominal_rate(fps):
+    """Integer frame rate SMPTE timecode counts in, e.g 24 for 23.976
+    :param: Video Frame Rate e.g 23.98 or Fraction(24000, 1001)
+    :return: Integer (framerate)"""
+    return int(round(float(fps)))
+
+
+def timecode_to_frames(timecode, fps):
+    """Converts a frame number, HH:MM:SS:FF or HH:MM:SS[.mm] to frames
+    :param: Video Frame Rate e.g 25.0, HH:MM:SS:FF counts frames at its
+            nominal_rate and HH:MM:SS.mm is exact with Fraction(24000, 1001)
+    :return: Integer (frames)"""
+    if isinstance(timecode, (int, long)):
+        return timecode
+    timecode = str(timecode).strip()
+    if timecode.isdigit():
+        return int(timecode)
+    if re.match(r'^\d\d:\d\d:\d\d:\d\d$', timecode):
+        if int(timecode[9:]) >= nominal_rate(fps):
+            raise ValueError('Timecode %s has more frames than %s fps' %
+                             (timecode, nominal_rate(fps)))
+        return PyTimeCode(nominal_rate(fps), timecode).frames
+    if re.match(r'^\d\d:\d\d:\d\d(\.\d+)?$', timecode):
+        return int(round(timecode_to_seconds(timecode) * fps))
+    raise ValueError('Unrecognised timecode %s, expected a frame number, '
+                     'HH:MM:SS:FF or HH:MM:SS.mm' % timecode)